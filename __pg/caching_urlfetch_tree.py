@@ -1,11 +1,24 @@
-"""URL Fetch Tree which caches responses during the current request."""
+"""URL Fetch Tree which caches responses across requests on an instance.
 
+Responses are cached per request, as before, and additionally in an instance
+wide LRU cache which is revalidated against the project manifest once per
+request.
+"""
 
+
+import httplib
 import os
 
+from . import lru
+from . import settings
+from . import shared
 from . import urlfetch_tree
 
 
+# instance wide cache of (namespace, path) -> (etag, URL Fetch response)
+_FILE_CACHE = lru.LRUCache(settings.FILE_CACHE_MAX_BYTES)
+
+
 class CachingUrlFetchTree(urlfetch_tree.UrlFetchTree):
   """An caching implementation of URL Fetch Tree."""
 
@@ -14,17 +27,56 @@ class CachingUrlFetchTree(urlfetch_tree.UrlFetchTree):
     self.file_cache = {}
     # uniquely identifies the current HTTP request
     self.request_log_id = os.environ['REQUEST_LOG_ID']
+    # current path -> etag, lazily retrieved once per request
+    self._etags = None
+
+  def _GetEtags(self):
+    if self._etags is None:
+      self._etags = self.GetManifestEtags() or {}
+    return self._etags
 
   def RemoteGetFile(self, path):
-    # cache should not be used across multiple requests
+    # per request cache should not be used across multiple requests
     assert self.request_log_id == os.environ['REQUEST_LOG_ID']
     f = self.file_cache.get(path)
-    if not f:
+    if f:
+      return f
+    key = (self.namespace, path)
+    etag = self._GetEtags().get(path)
+    cached = _FILE_CACHE.Get(key)
+    if etag and cached and cached[0] == etag:
+      f = cached[1]
+    else:
       f = super(CachingUrlFetchTree, self).RemoteGetFile(path)
-      self.file_cache[path] = f
+      if f.status_code == httplib.OK:
+        _FILE_CACHE.Put(key, (shared.ContentHash(f.content), f),
+                        len(f.content))
+      else:
+        _FILE_CACHE.Pop(key)
+    self.file_cache[path] = f
     return f
 
   def RemotePutFile(self, path, content):
     resp = super(CachingUrlFetchTree, self).RemotePutFile(path, content)
     self.file_cache.pop(path, None)
+    _FILE_CACHE.Pop((self.namespace, path))
     return resp
+
+  def PutFiles(self, files):
+    super(CachingUrlFetchTree, self).PutFiles(files)
+    for path in files:
+      self.file_cache.pop(path, None)
+      _FILE_CACHE.Pop((self.namespace, path))
+
+  def MoveFile(self, path, newpath):
+    self._Invalidate()
+    return super(CachingUrlFetchTree, self).MoveFile(path, newpath)
+
+  def DeletePath(self, path):
+    self._Invalidate()
+    return super(CachingUrlFetchTree, self).DeletePath(path)
+
+  def _Invalidate(self):
+    # force revalidation of the instance wide cache against the manifest
+    self.file_cache.clear()
+    self._etags = None
@@ -0,0 +1,248 @@
+"""Module containing playground specific mimic control handlers.
+
+These handlers complement the control paths served by mimic itself and are
+served by the playground app, which has direct access to the project trees.
+"""
+
+import base64
+import httplib
+import posixpath
+
+import webapp2
+
+from mimic.__mimic import common
+
+from . import jsonutil
+from . import model
+from . import settings
+from . import shared
+from . import zipstream
+
+
+# batch read/write of many files in a single request
+FILES_PATH = '{}/files'.format(common.CONTROL_PREFIX)
+
+# file metadata (size, last modified, etag) without the file contents
+STAT_PATH = '{}/stat'.format(common.CONTROL_PREFIX)
+
+# content hashes of all files in the tree, for cache revalidation
+MANIFEST_PATH = '{}/manifest'.format(common.CONTROL_PREFIX)
+
+# files changed since a given manifest version
+DELTA_PATH = '{}/delta'.format(common.CONTROL_PREFIX)
+
+# project download as a zip archive, streamed while the files are read
+ZIP_PATH = '{}/zip'.format(common.CONTROL_PREFIX)
+
+# control paths which, like mimic's own, operate on a project tree
+CONTROL_PATHS_REQUIRING_TREE = [
+    FILES_PATH,
+    STAT_PATH,
+    MANIFEST_PATH,
+    DELTA_PATH,
+    ZIP_PATH,
+]
+
+
+def RequiresTree(path_info):
+  """Determine whether the given control path operates on a project tree."""
+  return (path_info in common.CONTROL_PATHS_REQUIRING_TREE or
+          path_info in CONTROL_PATHS_REQUIRING_TREE)
+
+
+def EncodeFiles(files):
+  """Encode a dict of path -> contents for JSON transport."""
+  return dict((path, base64.b64encode(contents))
+              for path, contents in files.iteritems())
+
+
+def DecodeFiles(data):
+  """Decode the output of EncodeFiles back into a dict of path -> contents."""
+  return dict((path, base64.b64decode(contents))
+              for path, contents in data.iteritems())
+
+
+class ControlHandler(webapp2.RequestHandler):
+  """Convenience request handler for project tree control requests.
+
+  Access checks are performed by middleware.MimicControlAccessFilter.
+  """
+
+  @webapp2.cached_property
+  def project(self):  # pylint:disable-msg=invalid-name
+    return self.request.environ['playground.project']
+
+  @webapp2.cached_property
+  def tree(self):  # pylint:disable-msg=invalid-name
+    return common.config.CREATE_TREE_FUNC(str(self.project.key.id()))
+
+  def WriteJson(self, r):
+    self.response.headers['Content-Type'] = jsonutil.JSON_MIME_TYPE
+    self.response.write(jsonutil.tojson(r))
+
+
+class Files(ControlHandler):
+  """Handler which reads or writes many files in a single request."""
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    # a missing 'path' means all files in the tree
+    path = self.request.GET.get('path')
+    files = self.tree.GetFiles(path)
+    self.WriteJson(EncodeFiles(files))
+
+  def put(self):  # pylint:disable-msg=invalid-name
+    files = DecodeFiles(jsonutil.fromjson(self.request.body) or {})
+    self.tree.PutFiles(files)
+    self.WriteJson({'count': len(files)})
+
+
+class Stat(ControlHandler):
+  """Handler which returns file metadata without the file contents.
+
+  The metadata comes from the project manifest, so that the file itself is
+  not read. Only projects with too many files to track read the file.
+  """
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    path = self.request.get('path')
+    manifest = model.GetOrBuildProjectManifest(self.project)
+    if manifest:
+      entry = next((e for e in manifest.entries if e.path == path), None)
+      if not entry:
+        self.response.set_status(httplib.NOT_FOUND)
+        return
+      size, last_modified, etag = entry.size, entry.mtime, entry.etag
+    else:
+      contents = self.tree.GetFileContents(path)
+      if contents is None:
+        self.response.set_status(httplib.NOT_FOUND)
+        return
+      size = len(contents)
+      last_modified = self.tree.GetFileLastModified(path)
+      etag = shared.ContentHash(contents)
+    self.WriteJson({
+        'size': size,
+        'last_modified': last_modified.strftime(common.RFC_1123_DATE_FORMAT),
+        'etag': etag,
+    })
+
+
+class Manifest(ControlHandler):
+  """Handler which returns the content hash of every file in the tree."""
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    manifest = model.GetOrBuildProjectManifest(self.project)
+    if manifest:
+      last_modified = manifest.last_modified
+      etags = dict((entry.path, entry.etag) for entry in manifest.entries)
+    else:
+      # projects with too many files to track
+      last_modified = model.GetProjectLastModified(self.project)
+      files = self.tree.GetFiles(None)
+      etags = dict((path, shared.ContentHash(contents))
+                   for path, contents in files.iteritems())
+    self.WriteJson({
+        'last_modified': last_modified.strftime(common.RFC_1123_DATE_FORMAT),
+        'etags': etags,
+    })
+
+
+class Delta(ControlHandler):
+  """Handler which returns the files changed since a given manifest version.
+
+  Without a 'since' parameter, or when nothing changed, only the current
+  manifest version is returned. Projects with too many files to track have
+  no versions and respond with 404.
+  """
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    manifest = model.GetOrBuildProjectManifest(self.project)
+    if not manifest:
+      self.response.set_status(httplib.NOT_FOUND)
+      return
+    r = {'version': manifest.version}
+    since = self.request.get('since')
+    if not since:
+      self.WriteJson(r)
+      return
+    try:
+      since = long(since)
+    except ValueError:
+      self.response.set_status(httplib.BAD_REQUEST)
+      return
+    if since == manifest.version:
+      self.WriteJson(r)
+      return
+    if since > manifest.version:
+      # unknown future version, send everything
+      since = -1
+    files = {}
+    mtimes = {}
+    paths = []
+    for entry in manifest.entries:
+      if entry.version <= since:
+        paths.append(entry.path)
+        continue
+      contents = self.tree.GetFileContents(entry.path)
+      if contents is None:
+        # not readable, so the file is treated as deleted
+        continue
+      files[entry.path] = contents
+      mtimes[entry.path] = entry.mtime.strftime(common.RFC_1123_DATE_FORMAT)
+      paths.append(entry.path)
+    r['files'] = EncodeFiles(files)
+    r['mtimes'] = mtimes
+    r['paths'] = paths
+    self.WriteJson(r)
+
+
+class Zip(ControlHandler):
+  """Handler which serves the project files as a zip archive.
+
+  Files are read and compressed one at a time, so that neither all file
+  contents nor a second copy of the archive are held at once. The Python 2.7
+  runtime buffers the whole response body before sending it however, so the
+  archive itself is not streamed to the client. Files are placed in a
+  directory named after the archive unless 'use_basepath' is 'false', and
+  'store' set to 'true' disables compression altogether.
+  """
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    filename = (self.request.get('filename') or
+                self.project.download_filename or
+                u'{}.zip'.format(self.project.project_name))
+    # keep the header well formed
+    for c in u'"\r\n':
+      filename = filename.replace(c, u'')
+    basepath = u''
+    if self.request.get('use_basepath') != 'false':
+      basepath = posixpath.splitext(filename)[0]
+    self.response.headers['Content-Type'] = 'application/zip'
+    self.response.headers['Content-Disposition'] = (
+        'attachment; filename="{}"'.format(filename.encode('utf-8')))
+    self.response.app_iter = zipstream.ZipStream(
+        self._IterFiles(basepath),
+        stored_extensions=settings.ZIP_STORED_EXTENSIONS,
+        store_only=self.request.get('store') == 'true')
+
+  def _IterFiles(self, basepath):
+    for path in self.tree.ListDirectory(None):
+      if path.endswith('/'):
+        # directories are implied by the paths of their files
+        continue
+      if isinstance(path, str):
+        path = path.decode('utf-8')
+      contents = self.tree.GetFileContents(path)
+      if contents is None:
+        continue
+      mtime = self.tree.GetFileLastModified(path)
+      yield posixpath.join(basepath, path), contents, mtime
+
+
+app = webapp2.WSGIApplication([
+    (FILES_PATH, Files),
+    (STAT_PATH, Stat),
+    (MANIFEST_PATH, Manifest),
+    (DELTA_PATH, Delta),
+    (ZIP_PATH, Zip),
+], debug=settings.DEBUG)
@@ -22,6 +22,14 @@ class PlaygroundError(Exception):
     return text.encode('unicode-escape')
 
 
+class TooManyFilesError(PlaygroundError):
+  """A write would grow a project beyond settings.MAX_PROJECT_FILES."""
+
+  def __init__(self, message):
+    super(TooManyFilesError, self).__init__(httplib.REQUEST_ENTITY_TOO_LARGE,
+                                            cgi.escape(message))
+
+
 def Abort(status_code, message):
   logging.debug('Abort {} {}'.format(status_code, message))
   raise PlaygroundError(int(status_code), cgi.escape(message))
@@ -4,9 +4,11 @@ import httplib
 import json
 
 from . import model
+from . import settings
 from . import shared
 
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 
 
 # pylint:disable-msg=nonstandard-exception
@@ -24,29 +26,54 @@ class FetchError(urlfetch.Error):
 
 
 class Fetcher(object):
-  """A wrapper for URL fetch which performs validation and conversion."""
+  """A wrapper for URL fetch which performs validation and conversion.
+
+  The cached resource lookup and the conditional URL fetch which depends on it
+  run asynchronously, so that many fetchers can be in flight at once.
+  """
 
   def __init__(self, url, url_auth_suffix='', follow_redirects=False,
-               headers=None):
+               headers=None, deadline=None, use_cache=True):
+    """Constructor.
+
+    Args:
+      url: The url to fetch.
+      url_auth_suffix: A suffix with credentials appended to the url.
+      follow_redirects: Whether to follow redirects.
+      headers: Additional request headers.
+      deadline: The URL Fetch deadline in seconds, or None for the default.
+      use_cache: Whether to revalidate and store the content as a Resource.
+          Large immutable content, such as archives of a given commit, should
+          not be cached.
+    """
     if headers is None:
       headers = {}
     self.url = url
+    self.use_cache = use_cache
     self.response = None
-    self.etag, self.response_content = model.GetResource(url)
+    self.etag = self.response_content = None
+    full_url = '{}{}'.format(url, url_auth_suffix)
+    self.future = self._FetchAsync(full_url, headers, follow_redirects,
+                                   deadline)
+
+  @ndb.tasklet
+  def _FetchAsync(self, full_url, headers, follow_redirects, deadline):
+    if self.use_cache:
+      self.etag, self.response_content = yield model.GetResourceAsync(
+          self.url)
     if self.etag:
       headers['If-None-Match'] = '{}'.format(self.etag)
-    self.rpc = urlfetch.create_rpc()
-    full_url = '{}{}'.format(url, url_auth_suffix)
-    # shared.i('urlfetch.make_fetch_call {} {}'.format(headers, full_url))
-    urlfetch.make_fetch_call(self.rpc, full_url, headers=headers,
-                             follow_redirects=follow_redirects,
-                             validate_certificate=True)
+    # shared.i('urlfetch {} {}'.format(headers, full_url))
+    response = yield ndb.get_context().urlfetch(
+        full_url, headers=headers, follow_redirects=follow_redirects,
+        validate_certificate=True, deadline=deadline)
+    raise ndb.Return(response)
 
   def _CheckResponse(self):
     """Verify the current response."""
     if self.response:
       return
-    self.response = self.rpc.get_result()
+    self.response = self.future.get_result()
     shared.i('{} {}'.format(self.response.status_code, self.url))
     if self.response.content_was_truncated:
       raise FetchError(self.url, self.response)
@@ -54,8 +81,10 @@ class Fetcher(object):
       return
     if self.response.status_code == httplib.OK:
       self.response_content = self.response.content
-      self.etag = self.response.headers['ETag']
-      model.PutResource(self.url, self.etag, self.response_content)
+      self.etag = self.response.headers.get('ETag')
+      # not every server, e.g. the github archive server, sends an ETag
+      if self.etag and self.use_cache:
+        model.PutResource(self.url, self.etag, self.response_content)
       return
     if self.etag and self.response_content:
       shared.w('using existing content etag={}, url={}'
@@ -71,3 +100,35 @@ class Fetcher(object):
   @property
   def json_content(self):
     return json.loads(self.content)
+
+
+def FetchUnordered(items, fetch_func=Fetcher,
+                   window=settings.FETCH_CONCURRENCY):
+  """Fetch many urls with a bounded number of fetches in flight.
+
+  Args:
+    items: An iterable of (tag, url) tuples.
+    fetch_func: The function used to create a Fetcher for a url.
+    window: The maximum number of fetches in flight.
+
+  Yields:
+    (tag, fetcher) tuples in the order in which the fetches complete. The
+    fetcher content is ready, or raises the error which caused the fetch to
+    fail.
+  """
+  items = iter(items)
+  in_flight = {}
+
+  def Start():
+    for tag, url in items:
+      fetched = fetch_func(url)
+      in_flight[fetched.future] = (tag, fetched)
+      if len(in_flight) >= window:
+        return
+
+  Start()
+  while in_flight:
+    future = ndb.Future.wait_any(in_flight.keys())
+    tag, fetched = in_flight.pop(future)
+    Start()
+    yield tag, fetched
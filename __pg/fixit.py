@@ -28,6 +28,9 @@ def FixProject(project):
   if not project.access_key:
     project.access_key = secret.GenerateRandomString()
     dirty = True
+  if project.expiration_seconds and not project.expires_at:
+    # set by the put below
+    dirty = True
   # pylint:disable-msg=protected-access
   if project._properties.has_key('end_user_url'):
     project._properties.pop('end_user_url')
@@ -2,6 +2,7 @@
 
 from mimic import mimic_wsgi
 
+from . import control
 from . import middleware
 from . import settings
 from . import wsgi_config
@@ -15,6 +16,18 @@ control_app = middleware.Redirector(control_app)
 control_app = middleware.ProjectFilter(control_app)
 control_app = middleware.ErrorHandler(control_app, debug=settings.DEBUG)
 
+playground_control_app = control.app
+playground_control_app = middleware.MimicControlAccessFilter(
+    playground_control_app)
+playground_control_app = middleware.Session(playground_control_app,
+                                            wsgi_config.WSGI_CONFIG)
+playground_control_app = middleware.AccessKeyHttpHeaderFilter(
+    playground_control_app)
+playground_control_app = middleware.Redirector(playground_control_app)
+playground_control_app = middleware.ProjectFilter(playground_control_app)
+playground_control_app = middleware.ErrorHandler(playground_control_app,
+                                                 debug=settings.DEBUG)
+
 user_app = mimic_wsgi.Mimic
 user_app = middleware.MimicControlAccessFilter(user_app)
 user_app = middleware.AccessKeyCookieFilter(user_app)
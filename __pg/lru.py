@@ -0,0 +1,88 @@
+"""A size bounded least recently used cache."""
+
+import collections
+import time
+
+
+class LRUCache(object):
+  """A least recently used cache bounded by the total size of its values.
+
+  Instances are meant to be shared across requests on the same instance.
+  """
+
+  def __init__(self, max_size, ttl_seconds=None):
+    """Constructor.
+
+    Args:
+      max_size: The maximum total size of all values in the cache.
+      ttl_seconds: The number of seconds a value remains valid, or None for
+          values which remain valid until evicted.
+    """
+    self.max_size = max_size
+    self.ttl_seconds = ttl_seconds
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    # key -> (value, size, expiration time), least recently used first
+    self._entries = collections.OrderedDict()
+
+  def __repr__(self):
+    return ('<{0} entries={1} size={2} hits={3} misses={4}>'
+            .format(self.__class__.__name__, len(self._entries), self.size,
+                    self.hits, self.misses))
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def Get(self, key, default=None):
+    entry = self._entries.pop(key, None)
+    if entry is not None and entry[2] is not None and entry[2] < time.time():
+      self._Remove(key, entry)
+      entry = None
+    if entry is None:
+      self.misses += 1
+      return default
+    self.hits += 1
+    self._entries[key] = entry
+    return entry[0]
+
+  def Put(self, key, value, size):
+    """Add or replace a value, evicting least recently used values as needed.
+
+    Args:
+      key: The cache key.
+      value: The value to cache.
+      size: The size of the value, in the same unit as max_size.
+    """
+    self.Pop(key)
+    if size > self.max_size:
+      return
+    expires = None
+    if self.ttl_seconds is not None:
+      expires = time.time() + self.ttl_seconds
+    self._entries[key] = (value, size, expires)
+    self.size += size
+    while self.size > self.max_size:
+      self._Remove(*self._entries.popitem(last=False))
+
+  def Pop(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return None
+    self._Remove(key, entry)
+    return entry[0]
+
+  def Clear(self):
+    while self._entries:
+      self._Remove(*self._entries.popitem(last=False))
+
+  def _Remove(self, key, entry):
+    self.size -= entry[1]
+    self.OnRemove(key, entry[0])
+
+  def OnRemove(self, key, value):  # pylint:disable-msg=unused-argument
+    """Called when a value leaves the cache; subclasses may release it."""
+    pass
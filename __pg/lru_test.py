@@ -0,0 +1,116 @@
+"""Tests for lru."""
+
+import unittest
+
+from . import lru
+
+
+class _FakeTime(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def time(self):  # pylint:disable-msg=invalid-name
+    return self.now
+
+
+class _RecordingCache(lru.LRUCache):
+
+  def __init__(self, *args, **kwargs):
+    super(_RecordingCache, self).__init__(*args, **kwargs)
+    self.removed = []
+
+  def OnRemove(self, key, value):
+    self.removed.append((key, value))
+
+
+class LRUCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.time = _FakeTime()
+    self._real_time = lru.time
+    lru.time = self.time
+
+  def tearDown(self):
+    lru.time = self._real_time
+
+  def testGetAndPut(self):
+    cache = lru.LRUCache(10)
+    self.assertIsNone(cache.Get('a'))
+    self.assertEqual('default', cache.Get('a', 'default'))
+    cache.Put('a', 'A', 3)
+    self.assertEqual('A', cache.Get('a'))
+    self.assertIn('a', cache)
+    self.assertEqual(1, len(cache))
+    self.assertEqual(3, cache.size)
+    self.assertEqual(1, cache.hits)
+    self.assertEqual(2, cache.misses)
+
+  def testReplaceUpdatesSize(self):
+    cache = lru.LRUCache(10)
+    cache.Put('a', 'A', 3)
+    cache.Put('a', 'AA', 5)
+    self.assertEqual('AA', cache.Get('a'))
+    self.assertEqual(5, cache.size)
+
+  def testEvictsLeastRecentlyUsed(self):
+    cache = _RecordingCache(10)
+    cache.Put('a', 'A', 4)
+    cache.Put('b', 'B', 4)
+    # 'a' is now more recently used than 'b'
+    cache.Get('a')
+    cache.Put('c', 'C', 4)
+    self.assertNotIn('b', cache)
+    self.assertIn('a', cache)
+    self.assertIn('c', cache)
+    self.assertEqual(8, cache.size)
+    self.assertEqual([('b', 'B')], cache.removed)
+
+  def testValueLargerThanCache(self):
+    cache = lru.LRUCache(10)
+    cache.Put('a', 'A', 4)
+    cache.Put('big', 'BIG', 11)
+    self.assertNotIn('big', cache)
+    self.assertIn('a', cache)
+    self.assertEqual(4, cache.size)
+
+  def testPopAndClear(self):
+    cache = _RecordingCache(10)
+    cache.Put('a', 'A', 1)
+    cache.Put('b', 'B', 2)
+    self.assertEqual('A', cache.Pop('a'))
+    self.assertIsNone(cache.Pop('a'))
+    self.assertEqual(2, cache.size)
+    cache.Clear()
+    self.assertEqual(0, len(cache))
+    self.assertEqual(0, cache.size)
+    self.assertEqual([('a', 'A'), ('b', 'B')], cache.removed)
+
+  def testTimeToLive(self):
+    cache = _RecordingCache(10, ttl_seconds=5)
+    cache.Put('a', 'A', 1)
+    self.time.now += 5
+    self.assertEqual('A', cache.Get('a'))
+    self.time.now += 1
+    self.assertIsNone(cache.Get('a'))
+    self.assertNotIn('a', cache)
+    self.assertEqual(0, cache.size)
+    self.assertEqual([('a', 'A')], cache.removed)
+
+  def testPutRestartsTimeToLive(self):
+    cache = lru.LRUCache(10, ttl_seconds=5)
+    cache.Put('a', 'A', 1)
+    self.time.now += 4
+    cache.Put('a', 'A2', 1)
+    self.time.now += 4
+    self.assertEqual('A2', cache.Get('a'))
+
+  def testNoTimeToLive(self):
+    cache = lru.LRUCache(10)
+    cache.Put('a', 'A', 1)
+    self.time.now += 10 ** 9
+    self.assertEqual('A', cache.Get('a'))
+
+
+if __name__ == '__main__':
+  unittest.main()
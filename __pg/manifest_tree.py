@@ -0,0 +1,263 @@
+"""Datastore Tree which keeps the project manifest up to date.
+
+File contents which fit in a single entity are kept in the content addressed
+blob store and referenced from the project manifest, so that identical files
+are stored once and copying a tree only copies the manifest entries. Larger
+files, and files written before the blob store existed, remain in the
+underlying datastore tree.
+"""
+
+
+import contextlib
+
+from mimic.__mimic import datastore_tree
+
+from . import model
+from . import shared
+
+
+class ManifestDatastoreTree(datastore_tree.DatastoreTree):
+  """A datastore backed tree which records modifications in the manifest.
+
+  Trees whose namespace is not a project id are not tracked.
+  """
+
+  def __init__(self, namespace, *args, **kwargs):
+    super(ManifestDatastoreTree, self).__init__(namespace, *args, **kwargs)
+    self.namespace = namespace
+    try:
+      self._project_id = long(namespace)
+    except ValueError:
+      self._project_id = None
+    # True while a tracked modification is in progress, so that base class
+    # implementations which call other tracked methods are recorded only once
+    self._modifying = False
+    # the project manifest, lazily retrieved and kept current by our writes
+    self._manifest = None
+    # path -> ManifestEntry, derived from the manifest
+    self._entries = None
+
+  @contextlib.contextmanager
+  def _Modification(self):
+    outermost = not self._modifying
+    self._modifying = True
+    try:
+      yield outermost and self._project_id is not None
+    finally:
+      if outermost:
+        self._modifying = False
+
+  def _SetManifest(self, manifest):
+    self._manifest = manifest
+    self._entries = None
+
+  def _GetEntries(self, build=False):
+    """Returns path -> ManifestEntry, or None if the tree is not tracked.
+
+    Args:
+      build: Whether to build the manifest of a project which does not yet
+          have one, from the files in the underlying datastore tree. Trees
+          with too many files remain untracked.
+    """
+    if self._project_id is None:
+      return None
+    if self._manifest is None:
+      manifest = model.GetProjectManifest(self._project_id)
+      if not manifest and build:
+        # reads fall through to the datastore tree while there is no manifest
+        manifest = model.BuildProjectManifest(self._project_id, self)
+      self._SetManifest(manifest)
+    if self._manifest is None or self._manifest.untracked:
+      return None
+    if self._entries is None:
+      self._entries = dict((entry.path, entry)
+                           for entry in self._manifest.entries)
+    return self._entries
+
+  def GetFileContents(self, path):
+    entries = self._GetEntries()
+    if entries is None:
+      return super(ManifestDatastoreTree, self).GetFileContents(path)
+    entry = entries.get(path)
+    if not entry:
+      return None
+    if not entry.blob:
+      return super(ManifestDatastoreTree, self).GetFileContents(path)
+    return model.GetBlobs([entry.etag]).get(entry.etag)
+
+  def GetFiles(self, path):
+    entries = self._GetEntries()
+    if entries is None:
+      return super(ManifestDatastoreTree, self).GetFiles(path)
+    if path is not None:
+      path = self._NormalizeDirectoryPath(path)
+    selected = [entry for entry in entries.itervalues()
+                if path is None or entry.path.startswith(path)]
+    files = {}
+    if any(not entry.blob for entry in selected):
+      files.update(super(ManifestDatastoreTree, self).GetFiles(path))
+    blobs = model.GetBlobs([entry.etag for entry in selected if entry.blob])
+    for entry in selected:
+      if entry.blob and entry.etag in blobs:
+        files[entry.path] = blobs[entry.etag]
+    return files
+
+  def GetFileSize(self, path):
+    entries = self._GetEntries()
+    if entries is None:
+      return super(ManifestDatastoreTree, self).GetFileSize(path)
+    entry = entries.get(path)
+    return entry.size if entry else 0
+
+  def GetFileLastModified(self, path):
+    entries = self._GetEntries()
+    if entries is None:
+      return super(ManifestDatastoreTree, self).GetFileLastModified(path)
+    entry = entries.get(path)
+    return entry.mtime if entry else None
+
+  def HasFile(self, path):
+    entries = self._GetEntries()
+    if entries is None:
+      return super(ManifestDatastoreTree, self).HasFile(path)
+    # root always exists, even if there are no files in the tree
+    if path == '':  # pylint: disable-msg=C6403
+      return True
+    return path in entries
+
+  def HasDirectory(self, path):
+    if self._GetEntries() is None:
+      return super(ManifestDatastoreTree, self).HasDirectory(path)
+    return bool(self.ListDirectory(path))
+
+  def ListDirectory(self, path):
+    entries = self._GetEntries()
+    if entries is None:
+      return super(ManifestDatastoreTree, self).ListDirectory(path)
+    path = self._NormalizeDirectoryPath(path)
+    return shared.ListDirectoryPaths(entries, path)
+
+  def _WriteFiles(self, files, write_func):
+    """Write files to the blob store where possible, else to the datastore.
+
+    Args:
+      files: A dict mapping file paths to file contents.
+      write_func: The base class function which writes a dict of files.
+    """
+    entries = self._GetEntries(build=True)
+    if entries is None:
+      write_func(files)
+      return
+    # fail before writing any files
+    model.CheckProjectFileCount(self._project_id, len(entries),
+                                len(set(entries).union(files)))
+    blob_files = dict((path, contents) for path, contents in files.iteritems()
+                      if len(contents) <= model.MAX_BLOB_BYTES)
+    large_files = dict((path, contents) for path, contents in files.iteritems()
+                       if path not in blob_files)
+    model.PutBlobs(blob_files.values())
+    if large_files:
+      write_func(large_files)
+    for path in blob_files:
+      entry = entries.get(path)
+      if entry and not entry.blob:
+        # drop the stale copy in the datastore tree
+        super(ManifestDatastoreTree, self).DeletePath(path)
+    self._SetManifest(model.UpdateProjectManifestFiles(
+        self._project_id, files, blob_paths=set(blob_files)))
+
+  def SetFile(self, path, contents):
+    with self._Modification() as track:
+      if not track:
+        super(ManifestDatastoreTree, self).SetFile(path, contents)
+        return
+
+      def Write(files):
+        for p, c in files.iteritems():
+          super(ManifestDatastoreTree, self).SetFile(p, c)
+
+      self._WriteFiles({path: contents}, Write)
+
+  def PutFiles(self, files):
+    with self._Modification() as track:
+      if not track:
+        super(ManifestDatastoreTree, self).PutFiles(files)
+        return
+      self._WriteFiles(files, super(ManifestDatastoreTree, self).PutFiles)
+
+  def MoveFile(self, path, newpath):
+    with self._Modification() as track:
+      entries = self._GetEntries(build=True) if track else None
+      if entries is None:
+        return super(ManifestDatastoreTree, self).MoveFile(path, newpath)
+      result = True
+      entry = entries.get(path)
+      if entry and not entry.blob:
+        result = super(ManifestDatastoreTree, self).MoveFile(path, newpath)
+      self._SetManifest(
+          model.UpdateProjectManifestMove(self._project_id, path, newpath))
+      return result
+
+  def DeletePath(self, path):
+    with self._Modification() as track:
+      entries = self._GetEntries(build=True) if track else None
+      if entries is None:
+        return super(ManifestDatastoreTree, self).DeletePath(path)
+      # blobs are shared, only files in the datastore tree are deleted
+      result = super(ManifestDatastoreTree, self).DeletePath(path)
+      self._SetManifest(
+          model.UpdateProjectManifestDelete(self._project_id, path))
+      return result
+
+  def Clear(self):
+    with self._Modification() as track:
+      entries = self._GetEntries() if track else None
+      # trees whose files are all blobs have nothing in the datastore tree
+      if entries is None or not all(e.blob for e in entries.itervalues()):
+        super(ManifestDatastoreTree, self).Clear()
+      if entries is not None:
+        self._SetManifest(
+            model.UpdateProjectManifestDelete(self._project_id, ''))
+      elif track and self._manifest is not None:
+        # the now empty tree of an untracked project can be tracked again
+        self._SetManifest(
+            model.SetProjectManifestTracked(self._project_id, True))
+
+  def CopyFrom(self, src_tree):
+    """Copy all files from another tree by reference where possible.
+
+    Files of the source tree which are not yet in the blob store are added to
+    it, so that later copies of the same tree only copy manifest entries.
+
+    Args:
+      src_tree: The tree to copy from.
+
+    Returns:
+      True if the files were copied, False if the caller should copy them.
+    """
+    if not isinstance(src_tree, ManifestDatastoreTree):
+      return False
+    # pylint:disable-msg=protected-access
+    src_entries = src_tree._GetEntries(build=True)
+    if src_entries is None or self._GetEntries(build=True) is None:
+      return False
+    blob_entries = []
+    large_files = {}
+    for entry in src_entries.itervalues():
+      if not entry.blob:
+        contents = src_tree.GetFileContents(entry.path)
+        if contents is None:
+          continue
+        if len(contents) > model.MAX_BLOB_BYTES:
+          large_files[entry.path] = contents
+          continue
+        model.PutBlobs([contents])
+      blob_entries.append(entry)
+    with self._Modification():
+      self._SetManifest(
+          model.CopyProjectManifestEntries(self._project_id, blob_entries))
+      if large_files:
+        super(ManifestDatastoreTree, self).PutFiles(large_files)
+        self._SetManifest(
+            model.UpdateProjectManifestFiles(self._project_id, large_files))
+    return True
@@ -10,6 +10,7 @@ from webapp2_extras import security
 from webapp2_extras import sessions
 
 from . import appids
+from . import control
 from . import error
 from error import Abort
 from mimic.__mimic import common
@@ -30,6 +31,34 @@ _XSRF_TOKEN_COOKIE = 'XSRF-TOKEN'
 # AngularJS XSRF HTTP Header, see http://docs.angularjs.org/api/ng.$http
 _XSRF_TOKEN_HEADER = 'HTTP_X_XSRF_TOKEN'
 
+# environ key of the per request RequestContext
+_REQUEST_CONTEXT_KEY = 'playground.context'
+
+
+class RequestContext(object):
+  """Per request state which is parsed once and shared by all middleware.
+
+  Attributes:
+    request: The webapp2 request over the current environ.
+    session: The verified webapp2 session, once set by the Session middleware.
+  """
+
+  def __init__(self, environ):
+    self.request = webapp2.Request(environ)
+    self.session = None
+
+  @property
+  def cookies(self):
+    return self.request.cookies
+
+
+def GetRequestContext(environ):
+  """Returns the RequestContext of the current request, creating it once."""
+  context = environ.get(_REQUEST_CONTEXT_KEY)
+  if context is None:
+    context = environ[_REQUEST_CONTEXT_KEY] = RequestContext(environ)
+  return context
+
 
 def MakeCookieHeader(name, value, cookie_args=None):
   items = ['{}={}'.format(name, value)]
@@ -52,7 +81,7 @@ def MakeAnonUserKey():
 
 
 def AdoptAnonymousProjects(dest_user_key, source_user_key):
-  model.AdoptProjects(dest_user_key, source_user_key)
+  return model.AdoptProjects(dest_user_key, source_user_key)
 
 
 def GetOrMakeSession(request):
@@ -65,8 +94,9 @@ def GetOrMakeSession(request):
   user = users.get_current_user()
   if user:
     if _ANON_USER_KEY in session:
-      AdoptAnonymousProjects(user.email(), session[_ANON_USER_KEY])
-      del session[_ANON_USER_KEY]
+      # keep the anonymous user key until all projects have been adopted
+      if AdoptAnonymousProjects(user.email(), session[_ANON_USER_KEY]):
+        del session[_ANON_USER_KEY]
   else:
     if _ANON_USER_KEY not in session:
       session[_ANON_USER_KEY] = MakeAnonUserKey()
@@ -124,8 +154,10 @@ class Session(object):
   """WSGI middleware which adds user/project sessions.
 
   Adds the following keys to the environ:
+  - environ['playground.context'] contains the RequestContext
   - environ['playground.session'] contains a webapp2 session
-  - environ['playground.user']    contains the current user entity
+  - environ['playground.user']    contains the current user, which may not
+                                  yet exist in the datastore
   """
 
   def __init__(self, app, config):
@@ -161,8 +193,13 @@ class Session(object):
       return start_response(status, headers, exc_info)
 
     # 1. ensure we have a session
-    request = webapp2.Request(environ, app=self.app)
-    session = environ['playground.session'] = GetOrMakeSession(request)
+    context = GetRequestContext(environ)
+    if context.session is None:
+      request = context.request
+      # the session store reads its configuration from the request's app
+      request.app = self.app
+      context.session = GetOrMakeSession(request)
+    session = environ['playground.session'] = context.session
 
     if session.modified:
       additional_headers.extend([
@@ -170,11 +207,11 @@ class Session(object):
           self.MakeXsrfCookieHeader(session),
       ])
 
-    # 2. ensure we have an user entity
+    # 2. identify the user from the signed session cookie; the user entity is
+    # only created along with the user's first project
     user_key = GetUserKey(session)
     assert user_key
-    # TODO: avoid creating a datastore entity on every anonymous request
-    environ['playground.user'] = model.GetOrCreateUser(user_key)
+    environ['playground.user'] = model.GetUserPrincipal(user_key)
 
     # 3. perform CSRF checks
     if not shared.IsHttpReadMethod(environ):
@@ -197,7 +234,7 @@ class ProjectFilter(object):
   def __call__(self, environ, start_response):
     project_id = mimic.GetProjectId(environ, False)
     if project_id and shared.ThisIsPlaygroundApp():
-      project = model.GetProject(project_id)
+      project = model.GetCachedProject(project_id)
       if self._assert_project_existence:
         if not project:
           Abort(httplib.NOT_FOUND, 'project_id {} not found'.format(project_id))
@@ -216,9 +253,9 @@ class AccessKeyCookieFilter(object):
     self.app = app
 
   def __call__(self, environ, start_response):
-    request = webapp2.Request(environ, app=self.app)
-    access_key = (request.get(settings.ACCESS_KEY_SET_COOKIE_PARAM_NAME) or
-                  request.cookies.get(settings.ACCESS_KEY_COOKIE_NAME))
+    context = GetRequestContext(environ)
+    access_key = (context.request.get(settings.ACCESS_KEY_SET_COOKIE_PARAM_NAME)
+                  or context.cookies.get(settings.ACCESS_KEY_COOKIE_NAME))
     if access_key:
       environ['mimic.access_key'] = access_key
 
@@ -251,7 +288,7 @@ class AccessKeyHttpHeaderFilter(object):
     self.app = app
 
   def __call__(self, environ, start_response):
-    request = webapp2.Request(environ, app=self.app)
+    request = GetRequestContext(environ).request
     access_key = request.headers.get(settings.ACCESS_KEY_HTTP_HEADER)
     if access_key:
       environ['mimic.access_key'] = access_key
@@ -261,7 +298,8 @@ class AccessKeyHttpHeaderFilter(object):
 class MimicControlAccessFilter(object):
   """WSGI middleware which performs mimic project access checks.
 
-  Only checks paths which start with common.CONTROL_PREFIX.
+  Only checks paths which start with common.CONTROL_PREFIX, including the
+  playground's own control paths, see control.CONTROL_PATHS_REQUIRING_TREE.
 
   Requires that the following keys be present in the environ:
   - environ['playground.user']    contains the current user entity
@@ -274,7 +312,7 @@ class MimicControlAccessFilter(object):
     self.exc_info = None
 
   def _AssertCollaboratingAppIdAccessCheck(self, environ):
-    if environ['PATH_INFO'] in common.CONTROL_PATHS_REQUIRING_TREE:
+    if control.RequiresTree(environ['PATH_INFO']):
       if not shared.ThisIsPlaygroundApp():
         Abort(httplib.FORBIDDEN,
               'playground service is not available in this app id')
@@ -287,7 +325,7 @@ class MimicControlAccessFilter(object):
     if appids.TWO_COLLABORATING_APP_IDS:
       self._AssertCollaboratingAppIdAccessCheck(environ)
 
-    if environ['PATH_INFO'] in common.CONTROL_PATHS_REQUIRING_TREE:
+    if control.RequiresTree(environ['PATH_INFO']):
       if shared.IsHttpReadMethod(environ):
         if not shared.HasProjectReadAccess(environ):
           Abort(httplib.UNAUTHORIZED, 'no project read access to mimic control')
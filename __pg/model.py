@@ -1,12 +1,14 @@
 """Module containing the datastore mode and associated functions."""
 
-import os
+import logging
 import random
 import time
 
 from mimic.__mimic import common
 
 import datetime
+from error import TooManyFilesError
+from . import lru
 from . import secret
 from . import settings
 from . import shared
@@ -14,9 +16,30 @@ from . import shared
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.api.datastore_types import _MAX_RAW_PROPERTY_BYTES
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 
+# maximum size of a single memcache value, leaving room for overhead
+_MEMCACHE_CHUNK_BYTES = 1000 * 1000
+
+# maximum size of file contents which can be stored in the blob store
+MAX_BLOB_BYTES = _MAX_RAW_PROPERTY_BYTES
+
+# maximum number of entity groups in a cross group transaction
+_MAX_XG_ENTITY_GROUPS = 25
+
+# maximum number of values in a single IN query filter
+_MAX_QUERY_IN_VALUES = 30
+
+# memcache key of the current template project list version
+_MEMCACHE_KEY_TEMPLATE_PROJECTS_VERSION = 'template_projects_version'
+
+# instance wide cache of project id -> Project, in front of ndb's memcache
+_PROJECT_CACHE = lru.LRUCache(settings.PROJECT_CACHE_MAX_ENTRIES,
+                              ttl_seconds=settings.PROJECT_CACHE_TTL_SECONDS)
+
+
 class Global(ndb.Model):
   """A Model used to store the root entity for global configuration data.
 
@@ -43,7 +66,8 @@ class Project(ndb.Model):
   writers = ndb.StringProperty(repeated=True)
   created = ndb.DateTimeProperty(required=True, auto_now_add=True,
                                  indexed=False)
-  updated = ndb.DateTimeProperty(required=True, auto_now=True, indexed=False)
+  # set on every write, except those which only push out expires_at
+  updated = ndb.DateTimeProperty(required=True, indexed=False)
   show_files = ndb.StringProperty(required=False, repeated=True, indexed=False)
   read_only_files = ndb.StringProperty(required=False, repeated=True,
                                        indexed=False)
@@ -55,28 +79,116 @@ class Project(ndb.Model):
   access_key = ndb.StringProperty(required=True, indexed=False)
   expiration_seconds = ndb.IntegerProperty(required=True, indexed=False)
   hide_template = ndb.BooleanProperty(required=False)
+  # when the project expires unless it is modified, None if it never expires
+  expires_at = ndb.DateTimeProperty(required=False)
+
+  # whether the next put only pushes out expires_at, see _TouchProject
+  _touch_only = False
+
+  def _pre_put_hook(self):
+    if self._touch_only:
+      self._touch_only = False
+      return
+    # every other write counts as a modification, see also CheckExpiration
+    self.updated = datetime.datetime.now()
+    self.expires_at = _GetExpiresAt(self, self.updated)
+
+  def _post_put_hook(self, unused_future):
+    _PROJECT_CACHE.Pop(self.key.id())
+    if self.owner == settings.PUBLIC_PROJECT_TEMPLATE_OWNER:
+      _BumpTemplateProjectsVersion()
+
+  @classmethod
+  def _post_delete_hook(cls, key, unused_future):
+    _PROJECT_CACHE.Pop(key.id())
 
 
 class User(ndb.Model):
-  """A Model to store playground users."""
-  projects = ndb.KeyProperty(repeated=True, kind=Project, indexed=False)
+  """A Model to store playground users.
+
+  A user's projects are found by querying Project.owner.
+  """
   created = ndb.DateTimeProperty(required=True, auto_now_add=True,
                                  indexed=False)
   updated = ndb.DateTimeProperty(required=True, auto_now=True, indexed=False)
 
 
+class ManifestEntry(ndb.Model):
+  """A Model to describe a single file in a project manifest."""
+  path = ndb.StringProperty(required=True)
+  size = ndb.IntegerProperty(required=True)
+  mtime = ndb.DateTimeProperty(required=True)
+  etag = ndb.StringProperty(required=True)
+  # manifest version in which the file was last modified
+  version = ndb.IntegerProperty(required=True, default=0)
+  # whether the contents are in the blob store rather than in the tree itself
+  blob = ndb.BooleanProperty(required=True, default=False)
+
+
+class ProjectManifest(ndb.Model):
+  """A Model to store an index of the files in a project tree.
+
+  The project id is used as the entity key id.
+  """
+  entries = ndb.LocalStructuredProperty(ManifestEntry, repeated=True)
+  last_modified = ndb.DateTimeProperty(required=True, indexed=False)
+  # incremented on every tree modification
+  version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+  # trees with more than settings.MAX_PROJECT_FILES files are not tracked;
+  # their manifest has no entries and their files are in the datastore tree
+  untracked = ndb.BooleanProperty(required=False, default=False,
+                                  indexed=False)
+
+
+class ProjectCounterShard(ndb.Model):
+  """A Model to store one shard of the number of projects owned by a user.
+
+  The key id is '<user id>:<shard number>'. Shard 0 is created first, with
+  the number of projects the user owned when counting began.
+  """
+  count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+class Blob(ndb.Model):
+  """A Model to store file contents which may be shared by many projects.
+
+  The content hash is used as the entity key id. Blobs which are no longer
+  referenced by any project manifest are deleted, see MarkBlobs and
+  SweepBlobs.
+  """
+  content = ndb.BlobProperty(required=True)
+
+
+class BlobReference(ndb.Model):
+  """A Model to record when a blob was last referenced by a manifest.
+
+  Kept apart from the blob contents, as the only child of the Blob entity,
+  so that references can be refreshed without reading the contents.
+  """
+  # refreshed at most once per settings.BLOB_REFERENCE_SECONDS
+  last_referenced = ndb.DateTimeProperty(required=True)
+
+
 class Resource(ndb.Model):
   """A cache for web content.
 
   The url is used as the entity key.
   """
+  # memcache is managed explicitly, see GetResourceAsync
+  _use_memcache = False
+
   etag = ndb.StringProperty(required=True, indexed=False)
   content = ndb.BlobProperty(required=False)
   last_modified = ndb.DateTimeProperty(auto_now=True)
+  # number of ResourceChunk children when content is None
+  chunk_count = ndb.IntegerProperty(required=False, indexed=False)
+  content_hash = ndb.StringProperty(required=False, indexed=False)
 
 
 class ResourceChunk(ndb.Model):
   """A model for storing resources > _MAX_RAW_PROPERTY_BYTES."""
+  _use_memcache = False
+
   content = ndb.BlobProperty(required=True)
 
 
@@ -113,41 +225,514 @@ class Repo(ndb.Model):
   is_read_only = ndb.BooleanProperty(required=False)
   hide_template = ndb.BooleanProperty(required=False)
   download_filename = ndb.StringProperty(required=False)
+  # version, e.g. the commit SHA, from which the template project was created
+  imported_sha = ndb.StringProperty(required=False, indexed=False)
+
+
+class TemplateSnapshot(ndb.Model):
+  """A Model to record the files of an imported repo version.
+
+  The version, e.g. the commit SHA, is used as the entity key id, and the Repo
+  whose template project was populated is the parent, since repos at the same
+  version may have been imported with different success.
+  """
+  # path -> blob SHA
+  blobs = ndb.JsonProperty(required=True, compressed=True)
+  # whether every file of the version was imported; files which could not be
+  # retrieved are missing from blobs
+  complete = ndb.BooleanProperty(required=False, default=False, indexed=False)
+  created = ndb.DateTimeProperty(required=True, auto_now_add=True,
+                                 indexed=False)
+
+
+def _GetResourceKey(url):
+  return ndb.Key(Resource, url, namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def _GetResourceChunkKeys(resource_key, start, stop):
+  return [ndb.Key(ResourceChunk, i, parent=resource_key)
+          for i in range(start, stop)]
+
+
+def _GetResourceMemcacheKey(url, *suffixes):
+  # urls may exceed the maximum memcache key length
+  return ':'.join([Resource.__name__, shared.ContentHash(url)] +
+                  [str(suffix) for suffix in suffixes])
+
+
+@ndb.tasklet
+def _GetMemcachedResourceAsync(url):
+  ctx = ndb.get_context()
+  header = yield ctx.memcache_get(_GetResourceMemcacheKey(url),
+                                  namespace=settings.PLAYGROUND_NAMESPACE)
+  if not header:
+    raise ndb.Return(None, None)
+  etag, content_hash, chunk_count = header
+  keys = [_GetResourceMemcacheKey(url, content_hash, i)
+          for i in range(chunk_count)]
+  chunks = yield [ctx.memcache_get(key, namespace=settings.PLAYGROUND_NAMESPACE)
+                  for key in keys]
+  if None in chunks:
+    raise ndb.Return(None, None)
+  raise ndb.Return(etag, ''.join(chunks))
+
+
+@ndb.tasklet
+def _SetMemcachedResourceAsync(url, etag, content):
+  """Store a resource in memcache.
+
+  Content is split into chunks which fit in a memcache value. Chunk keys
+  include the content hash so that readers never mix chunks of different
+  versions.
+  """
+  ctx = ndb.get_context()
+  content_hash = shared.ContentHash(content)
+  chunks = [content[i:i + _MEMCACHE_CHUNK_BYTES]
+            for i in range(0, len(content), _MEMCACHE_CHUNK_BYTES)]
+  yield [ctx.memcache_set(_GetResourceMemcacheKey(url, content_hash, i),
+                          chunks[i], namespace=settings.PLAYGROUND_NAMESPACE)
+         for i in range(len(chunks))]
+  # header last, once all chunks are available
+  yield ctx.memcache_set(_GetResourceMemcacheKey(url),
+                         (etag, content_hash, len(chunks)),
+                         namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+@ndb.tasklet
+def GetResourceAsync(url):
+  """Asynchronously retrieve a previously stored resource.
+
+  Args:
+    url: The resource url.
+
+  Returns:
+    A future for an (etag, content) tuple, which is (None, None) if the
+    resource is not available.
+  """
+  etag, content = yield _GetMemcachedResourceAsync(url)
+  if etag:
+    raise ndb.Return(etag, content)
+  resource = yield _GetResourceKey(url).get_async()
+  if not resource:
+    raise ndb.Return(None, None)
+  if resource.content is not None:
+    content = resource.content
+  else:
+    if resource.chunk_count is None:
+      # stored before the number of chunks was recorded
+      chunks = yield ResourceChunk.query(ancestor=resource.key).fetch_async()
+    else:
+      keys = _GetResourceChunkKeys(resource.key, 1, resource.chunk_count + 1)
+      chunks = yield ndb.get_multi_async(keys)
+    if None in chunks:
+      shared.w('ignoring resource {} with missing chunks'.format(url))
+      raise ndb.Return(None, None)
+    content = ''.join(chunk.content for chunk in chunks)
+  # chunks are written without a transaction, a concurrent PutResource may
+  # have replaced some of them since the resource was read
+  if (resource.content_hash and
+      shared.ContentHash(content) != resource.content_hash):
+    shared.w('ignoring resource {} with mismatched content'.format(url))
+    raise ndb.Return(None, None)
+  yield _SetMemcachedResourceAsync(url, resource.etag, content)
+  raise ndb.Return(resource.etag, content)
 
 
 def GetResource(url):
   """Retrieve a previously stored resource."""
-  key = ndb.Key(Resource, url, namespace=settings.PLAYGROUND_NAMESPACE)
-  query = ndb.Query(ancestor=key)
-  results = query.fetch()
-  if not results:
-    return None, None
-  resource = results[0]
-  if resource.content is not None:
-    return resource.etag, resource.content
-  content = ''
-  for resource_chunk in results[1:]:
-    content += resource_chunk.content
-  return resource.etag, content
+  return GetResourceAsync(url).get_result()
 
 
 def PutResource(url, etag, content):
   """Persist a resource."""
-  key = ndb.Key(Resource, url, namespace=settings.PLAYGROUND_NAMESPACE)
-  keys = ndb.Query(ancestor=key).fetch(keys_only=True)
-  ndb.delete_multi(keys)
-  resource = Resource(id=url, etag=etag,
-                      namespace=settings.PLAYGROUND_NAMESPACE)
+  key = _GetResourceKey(url)
+  content_hash = shared.ContentHash(content)
+  old_resource = key.get()
+  if (old_resource and old_resource.etag == etag
+      and old_resource.content_hash == content_hash):
+    return
+  resource = Resource(key=key, etag=etag, content_hash=content_hash)
   if len(content) <= _MAX_RAW_PROPERTY_BYTES:
     resource.content = content
-    resource.put()
+    resource.chunk_count = 0
+    entities = [resource]
+  else:
+    chunks = [content[i:i + _MAX_RAW_PROPERTY_BYTES]
+              for i in range(0, len(content), _MAX_RAW_PROPERTY_BYTES)]
+    resource.chunk_count = len(chunks)
+    entities = [ResourceChunk(id=i + 1, parent=key, content=chunks[i])
+                for i in range(0, len(chunks))]
+    entities.append(resource)
+  ndb.put_multi(entities)
+  _SetMemcachedResourceAsync(url, etag, content).get_result()
+  # delete surplus chunks of the previous content
+  if not old_resource:
     return
-  chunks = [content[i:i + _MAX_RAW_PROPERTY_BYTES]
-            for i in range(0, len(content), _MAX_RAW_PROPERTY_BYTES)]
-  entities = [ResourceChunk(id=i + 1, parent=resource.key, content=chunks[i])
-              for i in range(0, len(chunks))]
-  entities.append(resource)
+  if old_resource.chunk_count is None:
+    keys = ResourceChunk.query(ancestor=key).fetch(keys_only=True)
+    keys = [k for k in keys if k.id() > resource.chunk_count]
+  else:
+    keys = _GetResourceChunkKeys(key, resource.chunk_count + 1,
+                                 old_resource.chunk_count + 1)
+  ndb.delete_multi(keys)
+
+
+def _GetBlobReferenceKey(etag):
+  return ndb.Key(Blob, etag, BlobReference, 1,
+                 namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def _GetStaleBlobReferenceTime():
+  return datetime.datetime.now() - datetime.timedelta(
+      0, settings.BLOB_REFERENCE_SECONDS)
+
+
+def GetBlobs(etags):
+  """Retrieve file contents from the content addressed blob store.
+
+  Args:
+    etags: The content hashes.
+
+  Returns:
+    A dict mapping content hashes to contents, without missing blobs.
+  """
+  keys = [ndb.Key(Blob, etag, namespace=settings.PLAYGROUND_NAMESPACE)
+          for etag in set(etags)]
+  return dict((blob.key.id(), blob.content)
+              for blob in ndb.get_multi(keys) if blob)
+
+
+def PutBlobs(contents):
+  """Add file contents to the content addressed blob store.
+
+  Args:
+    contents: A list of file contents, each at most MAX_BLOB_BYTES.
+
+  Returns:
+    A list of the content hashes.
+  """
+  blobs = dict((shared.ContentHash(c), c) for c in contents)
+  keys = [_GetBlobReferenceKey(etag) for etag in blobs]
+  stale = _GetStaleBlobReferenceTime()
+  now = datetime.datetime.now()
+  entities = []
+  # blobs are immutable, only write those which do not exist yet, or whose
+  # reference is stale and which may therefore be about to be deleted
+  for key, ref in zip(keys, ndb.get_multi(keys)):
+    if not ref or ref.last_referenced < stale:
+      entities.append(Blob(key=key.parent(), content=blobs[key.parent().id()]))
+      entities.append(BlobReference(key=key, last_referenced=now))
   ndb.put_multi(entities)
+  return [shared.ContentHash(c) for c in contents]
+
+
+@ndb.non_transactional
+def _ReferenceBlobs(etags):
+  """Record that existing blobs are referenced by a project manifest.
+
+  Must be called before a manifest refers to blobs it did not write itself,
+  see PutBlobs, so that the blobs are not deleted by a concurrent SweepBlobs.
+
+  Args:
+    etags: The content hashes.
+  """
+  keys = [_GetBlobReferenceKey(etag) for etag in set(etags)]
+  stale = _GetStaleBlobReferenceTime()
+  now = datetime.datetime.now()
+  ndb.put_multi([BlobReference(key=key, last_referenced=now)
+                 for key, ref in zip(keys, ndb.get_multi(keys))
+                 if not ref or ref.last_referenced < stale])
+
+
+def MarkBlobs(cursor=None):
+  """Refresh the references of the blobs used by a page of manifests.
+
+  Once all manifests have been marked, blobs which were not referenced since
+  are deleted by SweepBlobs.
+
+  Args:
+    cursor: The query cursor returned by the previous page, or None.
+
+  Returns:
+    The query cursor for the next page, or None if there are no more pages.
+  """
+  query = ProjectManifest.query(namespace=settings.PLAYGROUND_NAMESPACE)
+  manifests, next_cursor, more = query.fetch_page(
+      settings.BLOB_COLLECTION_PAGE_SIZE, start_cursor=cursor)
+  _ReferenceBlobs([entry.etag for manifest in manifests
+                   for entry in manifest.entries if entry.blob])
+  return next_cursor if more else None
+
+
+def SweepBlobs(marked, cursor=None):
+  """Delete a page of blobs which are no longer referenced.
+
+  Every blob referenced by a manifest since marking began was referenced at
+  most settings.BLOB_REFERENCE_SECONDS before then. Another such period is
+  allowed for manifest queries, which are eventually consistent, to catch up
+  with recently written manifests.
+
+  Args:
+    marked: When the preceding MarkBlobs pass began.
+    cursor: The query cursor returned by the previous page, or None.
+
+  Returns:
+    A tuple of the number of deleted blobs and the query cursor for the next
+    page, or None if there are no more pages.
+  """
+  cutoff = marked - datetime.timedelta(0, 2 * settings.BLOB_REFERENCE_SECONDS)
+  query = BlobReference.query(BlobReference.last_referenced < cutoff,
+                              namespace=settings.PLAYGROUND_NAMESPACE)
+  keys, next_cursor, more = query.fetch_page(
+      settings.BLOB_COLLECTION_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+  deleted = len([key for key in keys if _DeleteUnreferencedBlob(key, cutoff)])
+  return deleted, next_cursor if more else None
+
+
+@ndb.transactional
+def _DeleteUnreferencedBlob(ref_key, cutoff):
+  # the query result may be stale, the reference may have been refreshed
+  ref = ref_key.get()
+  if not ref or ref.last_referenced >= cutoff:
+    return False
+  ndb.delete_multi([ref_key, ref_key.parent()])
+  return True
+
+
+def _GetProjectManifestKey(project_id):
+  return ndb.Key(ProjectManifest, long(project_id),
+                 namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def GetProjectManifest(project_id):
+  return _GetProjectManifestKey(project_id).get()
+
+
+def CheckProjectFileCount(project_id, count, new_count):
+  """Fail a write which grows a project beyond settings.MAX_PROJECT_FILES.
+
+  Writes which do not add files are allowed, so that projects which already
+  exceed the limit can still be modified.
+
+  Args:
+    project_id: The project id.
+    count: The number of files before the write.
+    new_count: The number of files after the write.
+
+  Raises:
+    TooManyFilesError: If the write adds files beyond the limit.
+  """
+  if new_count > settings.MAX_PROJECT_FILES and new_count > count:
+    raise TooManyFilesError('project {} may contain at most {} files, not {}'
+                            .format(project_id, settings.MAX_PROJECT_FILES,
+                                    new_count))
+
+
+def _NewProjectManifest(project_id, entries):
+  manifest = ProjectManifest(key=_GetProjectManifestKey(project_id),
+                             entries=entries,
+                             last_modified=datetime.datetime.now())
+  if entries:
+    manifest.last_modified = max(entry.mtime for entry in entries)
+  return manifest
+
+
+@ndb.transactional
+def _UpdateProjectManifest(project_id, update_func):
+  """Apply a tree modification to the project manifest.
+
+  Projects without a manifest are left alone; their manifest is built in full
+  the next time it is needed, see GetOrBuildProjectManifest.
+
+  Args:
+    project_id: The project id.
+    update_func: A function which modifies a dict of path -> ManifestEntry,
+        given the new manifest version.
+
+  Returns:
+    The updated manifest or None.
+  """
+  manifest = GetProjectManifest(project_id)
+  if not manifest or manifest.untracked:
+    return None
+  manifest.version += 1
+  entries = dict((entry.path, entry) for entry in manifest.entries)
+  update_func(entries, manifest.version)
+  CheckProjectFileCount(project_id, len(manifest.entries), len(entries))
+  manifest.entries = [entries[path] for path in sorted(entries)]
+  manifest.last_modified = datetime.datetime.now()
+  manifest.put()
+  return manifest
+
+
+def UpdateProjectManifestFiles(project_id, files, blob_paths=()):
+  """Record new or updated files in the project manifest.
+
+  Args:
+    project_id: The project id.
+    files: A dict mapping file paths to file contents.
+    blob_paths: The paths whose contents are in the blob store.
+
+  Returns:
+    The updated manifest or None.
+  """
+  now = datetime.datetime.now()
+
+  def Update(entries, version):
+    for path, contents in files.iteritems():
+      entries[path] = ManifestEntry(path=path, size=len(contents), mtime=now,
+                                    etag=shared.ContentHash(contents),
+                                    version=version,
+                                    blob=path in blob_paths)
+
+  return _UpdateProjectManifest(project_id, Update)
+
+
+def CopyProjectManifestEntries(project_id, src_entries):
+  """Record files copied by reference to the blob store in the manifest.
+
+  Args:
+    project_id: The project id.
+    src_entries: The ManifestEntry of each copied file, whose contents must be
+        in the blob store.
+
+  Returns:
+    The updated manifest or None.
+  """
+  now = datetime.datetime.now()
+  _ReferenceBlobs([entry.etag for entry in src_entries])
+
+  def Update(entries, version):
+    for entry in _CopyManifestEntries(src_entries, now, version):
+      entries[entry.path] = entry
+
+  return _UpdateProjectManifest(project_id, Update)
+
+
+def _CopyManifestEntries(src_entries, mtime, version):
+  return [ManifestEntry(path=entry.path, size=entry.size, mtime=mtime,
+                        etag=entry.etag, version=version, blob=True)
+          for entry in src_entries]
+
+
+def _GetLinkableManifestEntries(project):
+  """Get the manifest entries of a project whose files are all blobs.
+
+  Args:
+    project: The project.
+
+  Returns:
+    The manifest entries, or None if any files are not in the blob store.
+  """
+  manifest = GetProjectManifest(project.key.id())
+  if (not manifest or manifest.untracked or
+      not all(entry.blob for entry in manifest.entries)):
+    return None
+  return manifest.entries
+
+
+def UpdateProjectManifestMove(project_id, path, newpath):
+  """Record a file move in the project manifest."""
+  now = datetime.datetime.now()
+
+  def Update(entries, version):
+    entry = entries.pop(path, None)
+    if entry:
+      entry.path = newpath
+      entry.mtime = now
+      entry.version = version
+      entries[newpath] = entry
+
+  return _UpdateProjectManifest(project_id, Update)
+
+
+def UpdateProjectManifestDelete(project_id, path):
+  """Record the deletion of a file or directory in the project manifest.
+
+  Args:
+    project_id: The project id.
+    path: The file or directory path, or '' for the entire tree.
+
+  Returns:
+    The updated manifest or None.
+  """
+  dir_path = path.rstrip('/') + '/'
+
+  def Update(entries, unused_version):
+    for p in entries.keys():
+      if not path or p == path or p.startswith(dir_path):
+        del entries[p]
+
+  return _UpdateProjectManifest(project_id, Update)
+
+
+def BuildProjectManifest(project_id, tree):
+  """Build a complete manifest for a project which does not yet have one.
+
+  Trees with more than settings.MAX_PROJECT_FILES files, which predate the
+  limit, are marked as untracked rather than indexed.
+
+  Args:
+    project_id: The project id.
+    tree: The project tree, whose files are all in the datastore tree.
+
+  Returns:
+    The manifest, which may be untracked.
+  """
+  paths = [path for path in tree.ListDirectory(None)
+           if not path.endswith('/')]
+  if len(paths) > settings.MAX_PROJECT_FILES:
+    shared.w('not tracking the {} files of project {}'
+             .format(len(paths), project_id))
+    manifest = _NewProjectManifest(project_id, [])
+    manifest.untracked = True
+    manifest.put()
+    return manifest
+  entries = []
+  for path in paths:
+    contents = tree.GetFileContents(path)
+    if contents is None:
+      continue
+    entries.append(ManifestEntry(path=path, size=len(contents),
+                                 mtime=tree.GetFileLastModified(path),
+                                 etag=shared.ContentHash(contents)))
+  manifest = _NewProjectManifest(project_id, entries)
+  manifest.put()
+  return manifest
+
+
+def GetOrBuildProjectManifest(project):
+  """Get the project manifest, or None if the project is not tracked."""
+  manifest = GetProjectManifest(project.key.id())
+  if not manifest:
+    manifest = BuildProjectManifest(project.key.id(),
+                                    _CreateProjectTree(project))
+  if manifest.untracked:
+    return None
+  return manifest
+
+
+@ndb.transactional
+def SetProjectManifestTracked(project_id, tracked):
+  """Start or stop tracking the files of an empty project tree.
+
+  Args:
+    project_id: The project id.
+    tracked: Whether to track the project files in the manifest.
+
+  Returns:
+    The new manifest.
+  """
+  manifest = GetProjectManifest(project_id)
+  if manifest and manifest.entries:
+    shared.e('project {} is not empty', project_id)
+  new_manifest = _NewProjectManifest(project_id, [])
+  new_manifest.untracked = not tracked
+  # the version keeps increasing, see control.Delta
+  if manifest:
+    new_manifest.version = manifest.version + 1
+  new_manifest.put()
+  return new_manifest
 
 
 def GetOAuth2Credential(key):
@@ -171,8 +756,12 @@ def GetRepo(repo_url):
 def CreateRepoAsync(owner, repo_url, html_url, name, description, show_files,
                     read_only_files, read_only_demo_url, orderby=None,
                     download_filename=None, hide_template=False,
-                    is_read_only=False):
-  """Asynchronously create a repo."""
+                    is_read_only=False, force=False):
+  """Asynchronously create a repo.
+
+  The template project of an existing repo is brought up to date with the
+  repo, or imported again in full if force is True.
+  """
   repo = GetRepo(repo_url)
   if not repo:
     repo = Repo(id=repo_url,
@@ -192,9 +781,12 @@ def CreateRepoAsync(owner, repo_url, html_url, name, description, show_files,
     shared.w('ignoring recreation of {} which is already executing in task {}'
              .format(repo_url, repo.in_progress_task_name))
     return
+  params = {'repo_url': repo_url}
+  if force:
+    params['force'] = 'true'
   task = taskqueue.add(queue_name='repo',
                        url='/_playground_tasks/populate_repo',
-                       params={'repo_url': repo_url},
+                       params=params,
                        transactional=True)
   shared.i('task {} added to populate repo {}'.format(task.name, repo_url))
   repo.in_progress_task_name = task.name
@@ -220,6 +812,17 @@ def CreateRepoAsync(owner, repo_url, html_url, name, description, show_files,
   return repo
 
 
+def GetTemplateSnapshot(repo, sha):
+  return TemplateSnapshot.get_by_id(sha, parent=repo.key)
+
+
+def PutTemplateSnapshot(repo, sha, blobs, complete):
+  snapshot = TemplateSnapshot(id=sha, parent=repo.key, blobs=blobs,
+                              complete=complete)
+  snapshot.put()
+  return snapshot
+
+
 def GetUser(user_id):
   return User.get_by_id(user_id, namespace=settings.PLAYGROUND_NAMESPACE)
 
@@ -228,18 +831,75 @@ def GetOrCreateUser(user_id):
   return User.get_or_insert(user_id, namespace=settings.PLAYGROUND_NAMESPACE)
 
 
-def GetProjects(user):
-  projects = ndb.get_multi(user.projects)
-  if None in projects:
-    # users.projects references projects which do not exist
-    missing_projects = [key for (key, prj) in zip(user.projects, projects)
-                        if prj is None]
-    if common.IsDevMode():
-      shared.e('Missing project(s): {0}'.format(missing_projects))
-    else:
-      shared.w('Missing project(s): {0}'.format(missing_projects))
-      projects = [p for p in projects if p is not None]
-  return projects
+def GetUserPrincipal(user_id):
+  """Returns an unsaved User which identifies the given user.
+
+  Regular users do not need a stored User entity; their projects are found
+  by querying Project.owner, see GetProjectsPage.
+
+  Args:
+    user_id: The user id.
+
+  Returns:
+    A User entity, which may not exist in the datastore.
+  """
+  return User(id=user_id, namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def _GetProjectCounterShardKey(user_id, shard):
+  return ndb.Key(ProjectCounterShard, '{}:{}'.format(user_id, shard),
+                 namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+@ndb.non_transactional
+def _InitProjectCounter(user_id):
+  """Start counting a user's projects, if not already started.
+
+  Called before any shard is adjusted, so that projects created before
+  counting began are counted exactly once.
+
+  Args:
+    user_id: The user id.
+  """
+  key = _GetProjectCounterShardKey(user_id, 0)
+  if key.get():
+    return
+  count = _QueryProjectsOwnedBy(user_id).count(keys_only=True)
+  ProjectCounterShard.get_or_insert(key.id(), count=count,
+                                    namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+@ndb.tasklet
+def _AdjustProjectCounterAsync(user_id, delta):
+  """Adjust a random shard of the user's project count.
+
+  Spreading writes over settings.PROJECT_COUNTER_SHARDS entity groups avoids
+  contention between concurrent project creations of the same user.
+
+  Args:
+    user_id: The user id.
+    delta: The change in the number of projects.
+  """
+  _InitProjectCounter(user_id)
+  shard = random.randint(0, settings.PROJECT_COUNTER_SHARDS - 1)
+  key = _GetProjectCounterShardKey(user_id, shard)
+  counter = yield key.get_async()
+  counter = counter or ProjectCounterShard(key=key)
+  counter.count += delta
+  yield counter.put_async()
+
+
+def GetUserProjectCount(user_id):
+  """Returns the number of projects owned by a user, e.g. for quotas."""
+  _InitProjectCounter(user_id)
+  keys = [_GetProjectCounterShardKey(user_id, shard)
+          for shard in range(settings.PROJECT_COUNTER_SHARDS)]
+  return sum(counter.count for counter in ndb.get_multi(keys) if counter)
+
+
+def _QueryProjectsOwnedBy(user_id):
+  return Project.query(Project.owner == user_id,
+                       namespace=settings.PLAYGROUND_NAMESPACE)
 
 
 def GetProject(project_id):
@@ -252,11 +912,95 @@ def GetProject(project_id):
   return project
 
 
+def GetCachedProject(project_id):
+  """Get a project, preferably from the instance wide project cache.
+
+  Projects written on this instance leave the cache immediately. Writes on
+  other instances become visible within settings.PROJECT_CACHE_TTL_SECONDS.
+
+  Args:
+    project_id: The project id.
+
+  Returns:
+    The project or None.
+  """
+  try:
+    project_id = long(project_id)
+  except ValueError:
+    return None
+  project = _PROJECT_CACHE.Get(project_id)
+  if project is None:
+    project = GetProject(project_id)
+    if project:
+      _PROJECT_CACHE.Put(project_id, project, 1)
+  return project
+
+
 def GetPublicTemplateProjects():
-  """Get template projects."""
-  user = GetPublicTemplateOwner()
-  projects = GetProjects(user)
-  return projects
+  """Get template projects.
+
+  Only the keys are queried; the projects themselves are read by key, so
+  that their contents, such as in_progress_task_name, are up to date.
+  """
+  keys = _QueryProjectsOwnedBy(settings.PUBLIC_PROJECT_TEMPLATE_OWNER).fetch(
+      keys_only=True)
+  return [prj for prj in ndb.get_multi(keys) if prj]
+
+
+def GetTemplateProjectsVersion():
+  """Returns the current version of the template project list.
+
+  Derived data, such as serialized template projects, may be cached in
+  memcache under a key which includes this version, once the version has
+  settled, see IsTemplateProjectsVersionSettled.
+
+  The version is the time of the last change in milliseconds.
+  """
+  version = memcache.get(_MEMCACHE_KEY_TEMPLATE_PROJECTS_VERSION,
+                         namespace=settings.PLAYGROUND_NAMESPACE)
+  if version is None:
+    # start from the current time so that versions are not reused after the
+    # version itself is evicted
+    memcache.add(_MEMCACHE_KEY_TEMPLATE_PROJECTS_VERSION,
+                 long(time.time() * 1000),
+                 namespace=settings.PLAYGROUND_NAMESPACE)
+    version = memcache.get(_MEMCACHE_KEY_TEMPLATE_PROJECTS_VERSION,
+                           namespace=settings.PLAYGROUND_NAMESPACE)
+  return version
+
+
+def IsTemplateProjectsVersionSettled(version):
+  """Whether queries for template projects reflect the given version."""
+  age = time.time() * 1000 - version
+  return age >= settings.TEMPLATE_PROJECTS_SETTLE_SECONDS * 1000
+
+
+def _BumpTemplateProjectsVersion():
+  version = memcache.get(_MEMCACHE_KEY_TEMPLATE_PROJECTS_VERSION,
+                         namespace=settings.PLAYGROUND_NAMESPACE) or 0
+  memcache.set(_MEMCACHE_KEY_TEMPLATE_PROJECTS_VERSION,
+               max(long(time.time() * 1000), version + 1),
+               namespace=settings.PLAYGROUND_NAMESPACE)
+
+
+def GetProjectsPage(user, cursor, limit):
+  """Get a page of the user's projects.
+
+  Args:
+    user: The user.
+    cursor: The urlsafe cursor returned with the previous page, or None.
+    limit: The maximum number of projects to return.
+
+  Returns:
+    A tuple of the projects and the cursor for the next page, or None if
+    there are no more projects.
+  """
+  if cursor:
+    cursor = Cursor(urlsafe=cursor)
+  projects, next_cursor, more = _QueryProjectsOwnedBy(
+      user.key.id()).fetch_page(limit, start_cursor=cursor)
+  next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+  return projects, next_cursor
 
 
 def _CreateProjectTree(project):
@@ -281,39 +1025,110 @@ def CopyProject(owner, template_project, expiration_seconds,
   expiration_seconds = max(settings.MIN_EXPIRATION_SECONDS, expiration_seconds)
   if not new_project_name:
     new_project_name = 'Copy of {}'.format(template_project.project_name)
-  description = template_project.project_description
-  retries = 5
-  for i in range(0, retries):
-    try:
-      project = CreateProject(
-        owner=owner,
-        template_url=template_project.template_url,
-        html_url=template_project.html_url,
-        project_name=new_project_name,
-        project_description=description,
-        show_files=template_project.show_files,
-        read_only_files=template_project.read_only_files,
-        read_only_demo_url=template_project.read_only_demo_url,
-        expiration_seconds=expiration_seconds,
-        orderby=template_project.orderby,
-        in_progress_task_name='copy_project',
-        download_filename=template_project.download_filename,
-        is_read_only=template_project.is_read_only,
-        hide_template=template_project.hide_template)
-      src_tree = _CreateProjectTree(template_project)
-      dst_tree = _CreateProjectTree(project)
-      CopyTree(dst_tree, src_tree)
-      project.in_progress_task_name=None
-      project.put()
-      return project
-    except Exception, e:
-      if i == retries - 1:
-        raise
-      shared.w('Will retry CreateProject which encountered {}'.format(e))
-      time.sleep(random.randint(1, 4))
+  project_args = dict(
+      owner=owner,
+      template_url=template_project.template_url,
+      html_url=template_project.html_url,
+      project_name=new_project_name,
+      project_description=template_project.project_description,
+      show_files=template_project.show_files,
+      read_only_files=template_project.read_only_files,
+      read_only_demo_url=template_project.read_only_demo_url,
+      expiration_seconds=expiration_seconds,
+      orderby=template_project.orderby,
+      download_filename=template_project.download_filename,
+      is_read_only=template_project.is_read_only,
+      hide_template=template_project.hide_template)
+  entries = _GetLinkableManifestEntries(template_project)
+  if entries is not None:
+    # the new project shares the template files, which are copied on write
+    return CreateProject(manifest_entries=entries, **project_args)
+  return _CreateProjectWithCopyTask(template_project, project_args)
+
+
+@ndb.transactional(xg=True)
+def _CreateProjectWithCopyTask(template_project, project_args):
+  project = CreateProject(**project_args)
+  task = ScheduleProjectCopy(project, template_project, transactional=True)
+  project.in_progress_task_name = task.name
+  project.put()
+  return project
+
+
+def ScheduleProjectCopy(project, template_project, job=None, batch=0,
+                        cursor=None, transactional=False):
+  """Add a task to copy the next batch of template files into a project.
+
+  Args:
+    project: The project being populated.
+    template_project: The template project to be copied.
+    job: The name of the first task of the copy, which owns the project, or
+        None to start a new copy.
+    batch: The batch number.
+    cursor: The last path copied by the previous batch, or None.
+    transactional: Whether to add the task transactionally.
+
+  Returns:
+    The task, or None if the task was already added.
+  """
+  params = {
+      'project_id': project.key.id(),
+      'template_project_id': template_project.key.id(),
+  }
+  name = None
+  if job:
+    params.update(job=job, batch=batch, cursor=cursor)
+    # named continuations make retries of the previous batch idempotent
+    name = '{}-{}'.format(job, batch)
+  try:
+    task = taskqueue.add(queue_name='copy',
+                         url='/_playground_tasks/copy_project',
+                         name=name,
+                         params=params,
+                         transactional=transactional)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    shared.w('task {} already added'.format(name))
+    return None
+  shared.i('task {} added to copy project {} into project {}'
+           .format(task.name, template_project.key.id(), project.key.id()))
+  return task
+
+
+def CopyProjectFiles(project, template_project, cursor):
+  """Copy the next batch of template files into a project.
+
+  Files are copied in path order. Copying the same batch again is harmless,
+  so a failed batch can simply be retried.
+
+  Args:
+    project: The project being populated.
+    template_project: The template project to be copied.
+    cursor: The last path copied by the previous batch, or None.
+
+  Returns:
+    The cursor for the next batch, or None once all files have been copied.
+  """
+  src_tree = _CreateProjectTree(template_project)
+  paths = sorted(path for path in src_tree.ListDirectory(None)
+                 if cursor is None or path > cursor)
+  batch = paths[:settings.TREE_WRITE_BATCH_SIZE]
+  files = {}
+  for path in batch:
+    contents = src_tree.GetFileContents(path)
+    if contents is not None:
+      files[path] = contents
+  if files:
+    _CreateProjectTree(project).PutFiles(files)
+  if len(paths) > len(batch):
+    return batch[-1]
+  return None
 
 
 def CopyTree(dst_tree, src_tree):
+  # copy-on-write trees copy references to the file contents instead
+  copy_from = getattr(dst_tree, 'CopyFrom', None)
+  if copy_from and copy_from(src_tree):
+    return
   files = src_tree.GetFiles(None)
   dst_tree.PutFiles(files)
 
@@ -328,29 +1143,6 @@ def ResetProject(project_id, project_tree):
   return project
 
 
-def GetProjectData(project_id, project_tree):
-  """Get project data.
-
-  Used to the playground to provide project downloads.
-
-  Args:
-    project_id: The project id.
-    project_tree: The project tree.
-  Returns:
-    Project data as a dict.
-  """
-  project = GetProject(project_id)
-  project_name = project.project_name
-  paths = project_tree.ListDirectory(None)
-  files = []
-  for path in paths:
-    if os.path.isdir(path):
-      continue
-    content = project_tree.GetFileContents(path)
-    files.append({'path': path, 'content': content})
-  return {'project_name': project_name, 'files': files}
-
-
 def RenameProject(project_id, project_name):
   project = GetProject(project_id)
   project.project_name = project_name
@@ -380,29 +1172,41 @@ def UpdateProject(project_id, data):
 
 
 def AdoptProjects(dst_user_id, src_user_id):
-  """Transfer project ownership to a new user."""
+  """Transfer project ownership to a new user.
+
+  Projects are transferred in as few cross group transactions as the entity
+  group limit allows, rather than one transaction per project.
+
+  Returns:
+    Whether the source user owns no more projects. The projects are found
+    with an eventually consistent query, so recently created projects may be
+    missed; the strongly consistent project count tells whether to retry.
+  """
 
   @ndb.transactional(xg=True)
-  def _AdoptProject(project_key, dst_user_key, src_user_key):
-    prj, dst_user, src_user = ndb.get_multi([project_key, dst_user_key,
-                                             src_user_key])
-    if project_key not in src_user.projects:
-      # another concurrent request and transaction beat us to it
-      return
-    src_user.projects.remove(project_key)
-    dst_user.projects.append(project_key)
-    prj.owner = dst_user_key.id()
-    prj.writers.remove(src_user_key.id())
-    prj.writers.append(dst_user_key.id())
-    ndb.put_multi([prj, dst_user, src_user])
-
-  src_user = GetUser(src_user_id)
-  if not src_user or not src_user.projects:
-    return
-  dst_user = GetOrCreateUser(dst_user_id)
-  for project_key in src_user.projects:
-    # slow, but transactionable
-    _AdoptProject(project_key, dst_user.key, src_user.key)
+  def _AdoptProjectBatch(project_keys):
+    adopted = []
+    for prj in ndb.get_multi(project_keys):
+      if not prj or prj.owner != src_user_id:
+        # another concurrent request and transaction beat us to it
+        continue
+      prj.owner = dst_user_id
+      prj.writers.remove(src_user_id)
+      prj.writers.append(dst_user_id)
+      adopted.append(prj)
+    ndb.put_multi(adopted)
+    if adopted:
+      futures = [_AdjustProjectCounterAsync(src_user_id, -len(adopted)),
+                 _AdjustProjectCounterAsync(dst_user_id, len(adopted))]
+      for future in futures:
+        future.get_result()
+
+  project_keys = _QueryProjectsOwnedBy(src_user_id).fetch(keys_only=True)
+  # a project counter shard of each user takes one entity group each
+  batch_size = _MAX_XG_ENTITY_GROUPS - 2
+  for i in range(0, len(project_keys), batch_size):
+    _AdoptProjectBatch(project_keys[i:i + batch_size])
+  return not GetUserProjectCount(src_user_id)
 
 
 def GetGlobalRootEntity():
@@ -426,15 +1230,17 @@ def DeleteReposAndTemplateProjects():
   user = GetPublicTemplateOwner()
 
   # delete template projects
-  keys = user.projects
-  ndb.delete_multi(keys)
+  projects = _QueryProjectsOwnedBy(user.key.id()).fetch()
+  DeleteProjects(projects)
 
   # delete ANONYMOUS user
   user.key.delete()
 
-  # delete code repositories
+  # delete code repositories and their imported versions
   query = Repo.query(namespace=settings.PLAYGROUND_NAMESPACE)
   keys = query.fetch(keys_only=True)
+  query = TemplateSnapshot.query(namespace=settings.PLAYGROUND_NAMESPACE)
+  keys += query.fetch(keys_only=True)
   ndb.delete_multi(keys)
 
   # delete repo collections
@@ -452,7 +1258,8 @@ def CreateProject(owner, template_url, html_url, project_name,
                   read_only_demo_url, expiration_seconds, orderby=None,
                   in_progress_task_name=None,
                   download_filename=None,
-                  is_read_only=False, hide_template=False):
+                  is_read_only=False, hide_template=False,
+                  manifest_entries=None):
   """Create a new user project.
 
   Args:
@@ -473,6 +1280,8 @@ def CreateProject(owner, template_url, html_url, project_name,
     is_read_only: True if the project cannot be edited in the UI.
     hide_template: True if the project/template should not appear on the main
         page, such as for samples that don't actually run on CP.
+    manifest_entries: Manifest entries of files in the blob store with which
+        to populate the project. Optional.
 
   Returns:
     The new project entity.
@@ -498,15 +1307,12 @@ def CreateProject(owner, template_url, html_url, project_name,
                 is_read_only=is_read_only,
                 hide_template=hide_template)
   prj.put()
-  # transactional get before update
-  owner = owner.key.get()
-  owner.projects.append(prj.key)
-  owner.put()
-  # call taskqueue to schedule expiration
-  if expiration_seconds:
-    expiration_date = prj.updated + datetime.timedelta(0, expiration_seconds)
-    # explicit expiration_date avoids reading back all the files we just created
-    ScheduleExpiration(prj, expiration_date)
+  # new projects start out with a complete manifest, which may reference
+  # existing files in the blob store
+  _ReferenceBlobs([entry.etag for entry in manifest_entries or []])
+  entries = _CopyManifestEntries(manifest_entries or [], prj.updated, 0)
+  _NewProjectManifest(prj.key.id(), entries).put()
+  _AdjustProjectCounterAsync(owner.key.id(), 1).get_result()
   return prj
 
 
@@ -518,50 +1324,120 @@ def GetProjectLastModified(project):
   Returns:
     A datetime object.
   """
+  manifest = GetOrBuildProjectManifest(project)
+  if manifest:
+    return max(project.updated, manifest.last_modified)
   last_modified = project.updated
   tree = _CreateProjectTree(project)
-  paths = tree.ListDirectory(None)
-  for path in paths:
+  for path in tree.ListDirectory(None):
     if path.endswith('/'):
       continue
-    file_mtime = tree.GetFileLastModified(path)
-    if file_mtime > last_modified:
-      last_modified = file_mtime
+    last_modified = max(last_modified, tree.GetFileLastModified(path))
   return last_modified
 
 
-def ScheduleExpiration(project, expiration_date):
-  base_url = '/playground/p/{0}/check_expiration'
-  expiration_url = base_url.format(project.key.id())
-  if expiration_date is None:
-    # deteimne expiration date based on last file access
-    expiration_date = (GetProjectLastModified(project) +
-                       datetime.timedelta(0, project.expiration_seconds))
-  taskqueue.add(queue_name='expiration',
-                url=expiration_url,
-                eta=expiration_date)
-
-
 def CheckExpiration(project):
   """Expires the project if appropriate.
 
-  Project expires if more than expiration_seconds
-  seconds has elapsed since last modification.  Used
-  in the CheckExpiration request handler.
+  Project expires if more than expiration_seconds seconds have elapsed since
+  last modification. File modifications do not update the project entity, so
+  the expires_at of projects which are not yet expired is pushed out to
+  match their last file modification.
 
   Args:
     project: the playground project
+
+  Returns:
+    True if the project was deleted.
   """
-  expiration_seconds = project.expiration_seconds
+  if not project.expiration_seconds:
+    return False
   now = datetime.datetime.now()
-  current_expiration_date = (GetProjectLastModified(project) +
-                             datetime.timedelta(0, expiration_seconds))
-  # Expire the project
-  if now > current_expiration_date:
-    DeleteProject(project)
+  last_modified = GetProjectLastModified(project)
+  # Expire the project, unless it changed since it was read
+  if _GetExpiresAt(project, last_modified) < now:
+    return bool(DeleteProjects([project], expired_before=now))
   # Defer expiration
-  else:
-    ScheduleExpiration(project, None)
+  _TouchProject(project.key, last_modified)
+  return False
+
+
+def _IsExpired(project, manifest, now):
+  """Determine whether a project, read with its manifest, has expired."""
+  if not project.expiration_seconds:
+    return False
+  # projects last written before expires_at was recorded have none
+  if project.expires_at and project.expires_at > now:
+    return False
+  last_modified = project.updated
+  if manifest and not manifest.untracked:
+    last_modified = max(last_modified, manifest.last_modified)
+  return _GetExpiresAt(project, last_modified) < now
+
+
+def _GetExpiresAt(project, last_modified):
+  if not project.expiration_seconds:
+    return None
+  return last_modified + datetime.timedelta(0, project.expiration_seconds)
+
+
+@ndb.transactional
+def _TouchProject(project_key, last_modified):
+  """Push out expires_at to match the last file modification.
+
+  Unlike other writes, project.updated is left alone, so that project lists
+  and GetProjectLastModified are unaffected.
+
+  Args:
+    project_key: The project key.
+    last_modified: The time the project was last modified.
+  """
+  project = project_key.get()
+  if not project:
+    return
+  expires_at = _GetExpiresAt(project, max(project.updated, last_modified))
+  if expires_at == project.expires_at:
+    return
+  project.expires_at = expires_at
+  # pylint:disable-msg=protected-access
+  project._touch_only = True
+  project.put()
+
+
+def SweepExpiredProjects(now, cursor=None):
+  """Expire a page of projects whose expires_at has passed.
+
+  Args:
+    now: The time at which the sweep began, which must be the same for all
+        pages, as query cursors are only valid for the same query.
+    cursor: The query cursor returned by the previous page, or None.
+
+  Returns:
+    A tuple of the number of deleted projects and the query cursor for the
+    next page, or None if there are no more pages.
+  """
+  query = Project.query(Project.expires_at < now,
+                        namespace=settings.PLAYGROUND_NAMESPACE)
+  projects, next_cursor, more = query.fetch_page(
+      settings.EXPIRATION_SWEEP_PAGE_SIZE, start_cursor=cursor)
+  expired = []
+  for project in projects:
+    if not project.expiration_seconds:
+      continue
+    # one broken project must not hold up the expiration of all others
+    try:
+      last_modified = GetProjectLastModified(project)
+      if _GetExpiresAt(project, last_modified) < now:
+        expired.append(project)
+      else:
+        _TouchProject(project.key, last_modified)
+    except Exception:  # pylint:disable-msg=broad-except
+      logging.exception('failed to check the expiration of project {}'
+                        .format(project.key.id()))
+  deleted = DeleteProjects(expired, expired_before=now) if expired else 0
+  if not more:
+    next_cursor = None
+  return deleted, next_cursor
 
 
 @ndb.transactional()
@@ -584,35 +1460,150 @@ def GetOrInsertRepoCollection(uri, description):
 def DeleteProject(project):
   """Delete an existing project."""
   assert project
-  tree = _CreateProjectTree(project)
-  # 1. delete files
-  tree.Clear()
+  DeleteProjects([project])
 
-  @ndb.transactional(xg=True)
-  def DelProject():
-    # 2. get current entities
-    prj = project.key.get()
-    user_key = ndb.Key(User, prj.owner, namespace=settings.PLAYGROUND_NAMESPACE)
-    usr = user_key.get()
-    # 3. delete project
-    prj.key.delete()
-    # 4. delete project references
-    if prj.key in usr.projects:
-      usr.projects.remove(prj.key)
-      usr.put()
-    else:
-      shared.i('ignoring project key {} not found in user projects {}'
-               .format(prj.key, usr.projects))
 
-  @ndb.transactional(xg=True)
-  def DelReposAndProject(keys):
-    ndb.delete_multi(keys)
-    DelProject()
-
-  repo_query = Repo.query(namespace=settings.PLAYGROUND_NAMESPACE)
-  repo_query = repo_query.filter(Repo.project == project.key)
-  keys = repo_query.fetch(keys_only=True)
-  if keys:
-    DelReposAndProject(keys)
-  else:
-    DelProject()
+def DeleteProjects(projects, expired_before=None):
+  """Delete many existing projects.
+
+  Each owner's projects are deleted, along with their manifests and any
+  repos referencing them, in cross group transactions which also update the
+  owner's project count. The files of each batch of deleted projects are
+  then deleted in bulk. Owners are processed concurrently, up to
+  settings.DELETE_CONCURRENCY at a time.
+
+  Args:
+    projects: The projects to delete.
+    expired_before: If given, projects are only deleted if they are still
+        expired at this time, as determined in the deleting transaction.
+        Used when the projects come from eventually consistent queries.
+
+  Returns:
+    The number of deleted projects.
+  """
+  start = time.time()
+  # 1. find repos, which only reference template projects
+  template_keys = [p.key for p in projects
+                   if p.owner in (settings.PUBLIC_PROJECT_TEMPLATE_OWNER,
+                                  settings.MANUAL_PROJECT_TEMPLATE_OWNER)]
+  repo_keys = {}
+  for i in range(0, len(template_keys), _MAX_QUERY_IN_VALUES):
+    keys = template_keys[i:i + _MAX_QUERY_IN_VALUES]
+    query = Repo.query(Repo.project.IN(keys),
+                       namespace=settings.PLAYGROUND_NAMESPACE)
+    for repo in query.fetch():
+      repo_keys.setdefault(repo.project, []).append(repo.key)
+
+  # 2. delete projects, their references and files, per owner
+  project_keys = {}
+  for project in projects:
+    project_keys.setdefault(project.owner, []).append(project.key)
+  futures = []
+  deleted = 0
+  for owner, keys in project_keys.iteritems():
+    if len(futures) >= settings.DELETE_CONCURRENCY:
+      future = ndb.Future.wait_any(futures)
+      futures.remove(future)
+      deleted += future.get_result()
+    futures.append(_DeleteOwnerProjectsAsync(owner, keys, repo_keys,
+                                             expired_before))
+  deleted += sum(future.get_result() for future in futures)
+
+  if template_keys:
+    _BumpTemplateProjectsVersion()
+  elapsed = time.time() - start
+  shared.i('deleted {} projects of {} owners in {:.1f}s ({:.1f} projects/s)'
+           .format(deleted, len(project_keys), elapsed,
+                   deleted / max(elapsed, 0.001)))
+  return deleted
+
+
+@ndb.tasklet
+def _DeleteOwnerProjectsAsync(owner, project_keys, repo_keys,
+                              expired_before):
+  """Delete an owner's projects, in as few transactions as possible.
+
+  Args:
+    owner: The owner's user id.
+    project_keys: The keys of the owner's projects to delete.
+    repo_keys: A dict mapping project keys to the keys of repos referencing
+        them.
+    expired_before: See DeleteProjects.
+
+  Returns:
+    The number of deleted projects.
+  """
+  deleted = 0
+  batch = []
+  # a project counter shard of the owner takes one of the entity groups
+  groups = 1
+  for key in project_keys:
+    # each project and its manifest are separate entity groups, as are repos
+    project_groups = 2 + len(repo_keys.get(key, []))
+    if batch and groups + project_groups > _MAX_XG_ENTITY_GROUPS:
+      deleted += yield _DeleteProjectBatchAsync(owner, batch, repo_keys,
+                                                expired_before)
+      batch = []
+      groups = 1
+    batch.append(key)
+    groups += project_groups
+  if batch:
+    deleted += yield _DeleteProjectBatchAsync(owner, batch, repo_keys,
+                                              expired_before)
+  raise ndb.Return(deleted)
+
+
+@ndb.tasklet
+def _DeleteProjectBatchAsync(owner, project_keys, repo_keys, expired_before):
+
+  @ndb.tasklet
+  def DelProjects():
+    # get current entities
+    prjs = yield ndb.get_multi_async(project_keys)
+    manifests = yield ndb.get_multi_async(
+        [_GetProjectManifestKey(key.id()) for key in project_keys])
+    # projects may already have been deleted by a concurrent request,
+    # adopted by another owner, whose project count we do not adjust, or
+    # modified since they were found to be expired
+    deleted = [(prj, manifest) for prj, manifest in zip(prjs, manifests)
+               if prj and prj.owner == owner and
+               (expired_before is None or
+                _IsExpired(prj, manifest, expired_before))]
+    # delete projects, their manifests and repos
+    delete_keys = []
+    for prj, unused_manifest in deleted:
+      delete_keys.append(prj.key)
+      delete_keys.append(_GetProjectManifestKey(prj.key.id()))
+      delete_keys.extend(repo_keys.get(prj.key, []))
+    yield ndb.delete_multi_async(delete_keys)
+    if deleted:
+      yield _AdjustProjectCounterAsync(owner, -len(deleted))
+    raise ndb.Return(deleted)
+
+  deleted = yield ndb.transaction_async(DelProjects, xg=True)
+  # each file is its own entity group, too many for the transaction
+  yield [_DeleteProjectFilesAsync(prj.key.id(), manifest)
+         for prj, manifest in deleted]
+  raise ndb.Return(len(deleted))
+
+
+@ndb.tasklet
+def _DeleteProjectFilesAsync(project_id, manifest):
+  """Delete the files a deleted project kept in its datastore tree.
+
+  Blobs are shared with other projects and deleted once they are no longer
+  referenced, see SweepBlobs.
+
+  Args:
+    project_id: The project id.
+    manifest: The project manifest, or None if the project had none.
+  """
+  if (manifest and not manifest.untracked and
+      all(entry.blob for entry in manifest.entries)):
+    # nothing in the datastore tree
+    return
+  # the tree namespace holds nothing but the deleted project's data
+  keys = yield ndb.Query(namespace=str(project_id)).fetch_async(
+      keys_only=True)
+  yield ndb.delete_multi_async([key for key in keys
+                                if not key.kind().startswith('__')])
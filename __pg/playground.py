@@ -22,6 +22,7 @@ from . import shared
 from template import templates
 from . import wsgi_config
 
+from google.appengine.api import memcache
 from google.appengine.api import users
 
 
@@ -281,11 +282,41 @@ class GetProjects(PlaygroundHandler):
   def PerformAccessCheck(self):
     pass
 
+  def _GetTemplateProjectDicts(self):
+    # template projects are shared by all users; only 'writable' differs
+    version = model.GetTemplateProjectsVersion()
+    key = 'template_project_dicts:{}:{}'.format(version, self.request.scheme)
+    r = memcache.get(key, namespace=settings.PLAYGROUND_NAMESPACE)
+    if r is None:
+      r = [self.DictOfProject(p) for p in model.GetPublicTemplateProjects()]
+      # right after a change the query may not reflect it yet
+      if model.IsTemplateProjectsVersionSettled(version):
+        memcache.set(key, r, namespace=settings.PLAYGROUND_NAMESPACE,
+                     time=settings.TEMPLATE_MEMCACHE_TIME)
+    for d in r:
+      d['writable'] = self.user.key.id() in d['writers']
+    return r
+
   def get(self):  # pylint:disable-msg=invalid-name
-    user_projects = model.GetProjects(self.user)
-    template_projects = model.GetPublicTemplateProjects()
-    projects = user_projects + template_projects
-    r = [self.DictOfProject(p) for p in projects]
+    """Handles HTTP GET requests.
+
+    Returns a page of the user's projects, followed on the first page by the
+    template projects. The cursor for the next page, if any, is returned in
+    the X-Playground-Next-Cursor response header.
+    """
+    cursor = self.request.get('cursor') or None
+    user_projects, next_cursor = model.GetProjectsPage(
+        self.user, cursor, settings.PROJECTS_PAGE_SIZE)
+    r = [self.DictOfProject(p) for p in user_projects]
+    if not cursor:
+      r += self._GetTemplateProjectDicts()
+    if next_cursor:
+      self.response.headers['X-Playground-Next-Cursor'] = next_cursor
+    etag = shared.ContentHash(jsonutil.tojson(r))
+    if etag in self.request.if_none_match:
+      self.response.set_status(httplib.NOT_MODIFIED)
+      return None
+    self.response.etag = etag
     return r
 
 
@@ -357,7 +388,8 @@ class RecreateTemplateProject(PlaygroundHandler):
                           description=repo.description,
                           show_files=repo.show_files,
                           read_only_files=repo.read_only_files,
-                          read_only_demo_url=repo.read_only_demo_url)
+                          read_only_demo_url=repo.read_only_demo_url,
+                          force=True)
 
 
 class NewProjectFromTemplateUrl(PlaygroundHandler):
@@ -499,7 +531,11 @@ class Nuke(PlaygroundHandler):
 
 
 class CheckExpiration(webapp2.RequestHandler):
-  """Checks to see if project should be expired."""
+  """Checks to see if project should be expired.
+
+  Only serves expiration tasks added before projects were expired by the
+  periodic sweep, see tasks.SweepExpiredProjects.
+  """
 
   def post(self):  # pylint:disable-msg=invalid-name
     project = self.request.environ.get('playground.project')
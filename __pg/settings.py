@@ -20,6 +20,14 @@ LONG_AGO = 'Mon, 01 Jan 1990 00:00:00 GMT'
 # 10 minutes
 TEMPLATE_MEMCACHE_TIME = 3600
 
+# seconds after a change to the template projects during which the template
+# project list is not cached, since the query finding the template projects
+# is eventually consistent and may still miss the change
+TEMPLATE_PROJECTS_SETTLE_SECONDS = 30
+
+# maximum number of user projects returned by a single getprojects request
+PROJECTS_PAGE_SIZE = 100
+
 # owners of template projects
 PUBLIC_PROJECT_TEMPLATE_OWNER = 'PUBLIC_TEMPLATE'
 MANUAL_PROJECT_TEMPLATE_OWNER = 'MANUAL_TEMPLATE'
@@ -68,9 +76,66 @@ MIN_EXPIRATION_SECONDS = 3600
 # One week
 DEFAULT_EXPIRATION_SECONDS = 604800
 
+# number of expired projects examined per expiration sweep task
+EXPIRATION_SWEEP_PAGE_SIZE = 100
+
+# number of project owners whose projects are deleted concurrently
+DELETE_CONCURRENCY = 10
+
+# maximum number of files in a project, whose manifest is kept in a single
+# entity of at most 1MB
+MAX_PROJECT_FILES = 1000
+
+# minimum interval between refreshes of a blob's last reference time.
+# Unreferenced blobs are deleted by the first collection which starts at least
+# two intervals after they were last referenced.
+BLOB_REFERENCE_SECONDS = 24 * 3600
+
+# number of manifests or blobs examined per blob collection task
+BLOB_COLLECTION_PAGE_SIZE = 50
+
+# number of shards of each user's project count
+PROJECT_COUNTER_SHARDS = 5
+
 # sentinnel value indicating a missing project
 NO_SUCH_PROJECT = 'NO_SUCH_PROJECT'
 
+# instance wide limit on cached project file contents
+FILE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# instance wide limit on the number of cached project entities
+PROJECT_CACHE_MAX_ENTRIES = 1000
+
+# seconds a cached project entity is used before it is read again, which
+# bounds staleness after a project is modified on another instance
+PROJECT_CACHE_TTL_SECONDS = 10
+
+# instance wide limit on cached project zips
+ZIP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# project zips of at least this size are cached in memory mapped temporary
+# files rather than in memory, or None to keep all zips in memory. Requires a
+# runtime with a writable file system and the mmap module.
+ZIP_CACHE_SPILL_THRESHOLD_BYTES = None
+
+# instance wide limit on project zips cached in temporary files
+ZIP_SPILL_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# extensions of already compressed files, which are stored rather than
+# deflated in project zip downloads
+ZIP_STORED_EXTENSIONS = ('png', 'jpg', 'jpeg', 'gif', 'ico', 'webp', 'zip',
+                         'gz', 'tgz', 'bz2', 'jar', 'mp3', 'mp4', 'woff',
+                         'woff2')
+
+# maximum number of URL fetches in flight when populating template projects
+FETCH_CONCURRENCY = 10
+
+# number of files written to a tree at once when populating template projects
+TREE_WRITE_BATCH_SIZE = 50
+
+# URL Fetch deadline in seconds for downloading a template repo archive
+ARCHIVE_FETCH_DEADLINE_SECONDS = 60
+
 # Extensions to exclude when creating template projects
 SKIP_EXTENSIONS = ('swp', 'pyc', 'svn')
 
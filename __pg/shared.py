@@ -1,5 +1,6 @@
 """Module for shared playground functions."""
 
+import hashlib
 import httplib
 import logging
 import os
@@ -60,6 +61,37 @@ def Fetch(access_key, url, method, payload=None, deadline=_URL_FETCH_DEADLINE,
       w('Will retry {} {} which encountered {}'.format(method, url, e))
 
 
+def ContentHash(contents):
+  """Returns the hex digest used as etag for the given file contents."""
+  return hashlib.sha1(contents).hexdigest()
+
+
+def ListDirectoryPaths(all_paths, path):
+  """List a directory given all file paths in a tree.
+
+  Args:
+    all_paths: All file paths in the tree.
+    path: The normalized directory path or None to list the entire tree.
+
+  Returns:
+    A sorted list of files and subdirectory names in the specified directory,
+    or all file paths in the tree.
+  """
+  paths = set()
+  for candidate_path in all_paths:
+    # 'path is None' means get all files recursively
+    if path is None:
+      paths.add(candidate_path)
+      continue
+    if not candidate_path.startswith(path):
+      continue
+    tail = candidate_path[len(path):]
+    # return tail if tail is a file otherwise return dir name (=first segment)
+    subpath = tail.split('/', 1)[0]
+    paths.add(subpath)
+  return sorted(paths)
+
+
 def GetCurrentTaskName():
   return os.environ.get('HTTP_X_APPENGINE_TASKNAME')
 
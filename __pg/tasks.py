@@ -1,13 +1,30 @@
 """Module containing template WSGI handlers."""
 
+import datetime
+
 import webapp2
 
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+
 from . import model
 from . import shared
 
 from template import templates
 
 
+# format of timestamps passed from one task to the next
+_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _GetTimestamp(request, name):
+  """Returns the named timestamp parameter, or the current time."""
+  value = request.get(name)
+  if not value:
+    return datetime.datetime.now()
+  return datetime.datetime.strptime(value, _TIMESTAMP_FORMAT)
+
+
 class PopulateRepoCollection(webapp2.RequestHandler):
 
   def post(self):  # pylint:disable-msg=invalid-name
@@ -25,6 +42,7 @@ class PopulateRepo(webapp2.RequestHandler):
 
   def post(self):  # pylint:disable-msg=invalid-name
     repo_url = self.request.get('repo_url')
+    force = self.request.get('force') == 'true'
     shared.i('task {} populating repo {}'.format(shared.GetCurrentTaskName(),
                                                  repo_url))
     repo = model.GetRepo(repo_url)
@@ -33,10 +51,110 @@ class PopulateRepo(webapp2.RequestHandler):
       project = repo.project.get()
       model.DeleteProject(project)
       return
-    collection.CreateTemplateProject(repo)
+    collection.CreateTemplateProject(repo, force=force)
+
+
+class CopyProject(webapp2.RequestHandler):
+
+  def post(self):  # pylint:disable-msg=invalid-name
+    project_id = self.request.get('project_id')
+    # the first task of a copy names the job, which owns the project
+    job = self.request.get('job') or shared.GetCurrentTaskName()
+    batch = int(self.request.get('batch', 0))
+    cursor = self.request.get('cursor') or None
+    shared.i('task {} copying batch {} of job {} into project {}'
+             .format(shared.GetCurrentTaskName(), batch, job, project_id))
+    project = model.GetProject(project_id)
+    if not project or project.in_progress_task_name != job:
+      shared.w('abandoning job {} which no longer owns project {}'
+               .format(job, project_id))
+      return
+    template_project = model.GetProject(self.request.get('template_project_id'))
+    if not template_project:
+      shared.w('deleting partial project {} whose template no longer exists'
+               .format(project_id))
+      model.DeleteProject(project)
+      return
+    cursor = model.CopyProjectFiles(project, template_project, cursor)
+    if cursor is None:
+      model.SetProjectOwningTask(project.key, None)
+      return
+    model.ScheduleProjectCopy(project, template_project, job=job,
+                              batch=batch + 1, cursor=cursor)
+
+
+class SweepExpiredProjects(webapp2.RequestHandler):
+  """Deletes expired projects, one page per task.
+
+  Started periodically by cron, see cron.yaml.
+  """
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    self.post()
+
+  def post(self):  # pylint:disable-msg=invalid-name
+    now = _GetTimestamp(self.request, 'now')
+    cursor = self.request.get('cursor', None)
+    if cursor:
+      cursor = Cursor(urlsafe=cursor)
+    deleted, next_cursor = model.SweepExpiredProjects(now, cursor)
+    shared.i('task {} expired {} projects'.format(shared.GetCurrentTaskName(),
+                                                  deleted))
+    if next_cursor:
+      taskqueue.add(queue_name='expiration',
+                    url='/_playground_tasks/sweep_expired_projects',
+                    params={'now': now.strftime(_TIMESTAMP_FORMAT),
+                            'cursor': next_cursor.urlsafe()})
+
+
+class MarkBlobs(webapp2.RequestHandler):
+  """Refreshes the references of blobs in use, one page per task.
+
+  Started periodically by cron, see cron.yaml. Once every manifest has been
+  examined, unreferenced blobs are deleted by SweepBlobs.
+  """
+
+  def get(self):  # pylint:disable-msg=invalid-name
+    self.post()
+
+  def post(self):  # pylint:disable-msg=invalid-name
+    marked = _GetTimestamp(self.request, 'marked')
+    cursor = self.request.get('cursor', None)
+    if cursor:
+      cursor = Cursor(urlsafe=cursor)
+    next_cursor = model.MarkBlobs(cursor)
+    params = {'marked': marked.strftime(_TIMESTAMP_FORMAT)}
+    if next_cursor:
+      params['cursor'] = next_cursor.urlsafe()
+      url = '/_playground_tasks/mark_blobs'
+    else:
+      url = '/_playground_tasks/sweep_blobs'
+    taskqueue.add(queue_name='blobs', url=url, params=params)
+
+
+class SweepBlobs(webapp2.RequestHandler):
+  """Deletes unreferenced blobs, one page per task."""
+
+  def post(self):  # pylint:disable-msg=invalid-name
+    marked = _GetTimestamp(self.request, 'marked')
+    cursor = self.request.get('cursor', None)
+    if cursor:
+      cursor = Cursor(urlsafe=cursor)
+    deleted, next_cursor = model.SweepBlobs(marked, cursor)
+    shared.i('task {} deleted {} blobs'.format(shared.GetCurrentTaskName(),
+                                               deleted))
+    if next_cursor:
+      taskqueue.add(queue_name='blobs',
+                    url='/_playground_tasks/sweep_blobs',
+                    params={'marked': marked.strftime(_TIMESTAMP_FORMAT),
+                            'cursor': next_cursor.urlsafe()})
 
 
 app = webapp2.WSGIApplication([
     ('/_playground_tasks/populate_repo_collection', PopulateRepoCollection),
     ('/_playground_tasks/populate_repo', PopulateRepo),
+    ('/_playground_tasks/copy_project', CopyProject),
+    ('/_playground_tasks/sweep_expired_projects', SweepExpiredProjects),
+    ('/_playground_tasks/mark_blobs', MarkBlobs),
+    ('/_playground_tasks/sweep_blobs', SweepBlobs),
 ], debug=True)
@@ -3,6 +3,7 @@
 
 import json
 
+from .. import error
 from .. import model
 from .. import shared
 
@@ -23,15 +24,36 @@ class RepoCollection(object):
     """
     self.repo_collection = repo_collection
 
-  def CreateTemplateProject(self, repo):
+  def CreateTemplateProject(self, repo, force=False):
+    """Populate or update the template project of a repo.
+
+    Args:
+      repo: The Repo entity.
+      force: Whether to import the repo in full, rather than only the changes
+          since the previous import.
+    """
     shared.EnsureRunningInTask()  # gives us automatic retries
     task_name = shared.GetCurrentTaskName()
     template_project = model.SetProjectOwningTask(repo.project, task_name)
-    tree = common.config.CREATE_TREE_FUNC(str(template_project.key.id()))
-    tree.Clear()
-    self.CreateProjectTreeFromRepo(tree, repo)
+    project_id = template_project.key.id()
+    tree = common.config.CREATE_TREE_FUNC(str(project_id))
+    try:
+      imported_sha = None
+      if not force:
+        imported_sha = self.UpdateProjectTreeFromRepo(tree, repo)
+      if not imported_sha:
+        tree.Clear()
+        imported_sha = self.CreateProjectTreeFromRepo(tree, repo)
+    except error.TooManyFilesError:
+      # import the repo in full again, without tracking the files
+      shared.w('repo {} has too many files to track'.format(repo.key.id()))
+      tree.Clear()
+      model.SetProjectManifestTracked(project_id, False)
+      tree = common.config.CREATE_TREE_FUNC(str(project_id))
+      imported_sha = self.CreateProjectTreeFromRepo(tree, repo)
     self.ParseAndApplyProjectSettings(tree, template_project)
     template_project = model.SetProjectOwningTask(repo.project, None)
+    repo.imported_sha = imported_sha
     repo.in_progress_task_name = None
     repo.put()
 
@@ -65,5 +87,25 @@ class RepoCollection(object):
     Args:
       tree: The Tree to populate.
       repo: The Repo entity.
+
+    Returns:
+      The imported repo version, e.g. a commit SHA, or None if the repo is not
+      versioned.
     """
     raise NotImplementedError
+
+  def UpdateProjectTreeFromRepo(self, tree, repo):
+    """Bring a project previously populated from the repo up to date.
+
+    Only applies the changes since repo.imported_sha, if any, and retries
+    files which could not be imported previously.
+
+    Args:
+      tree: The Tree to update.
+      repo: The Repo entity.
+
+    Returns:
+      The imported repo version, or None if the project must be populated from
+      scratch instead.
+    """
+    return None
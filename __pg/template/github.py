@@ -1,13 +1,18 @@
 """Module for accessing github.com projects."""
 
 import base64
+import contextlib
+import cStringIO
+import hashlib
 import re
 import sys
+import tarfile
 import traceback
 import yaml
 
 from .. import fetcher
 from .. import model
+from .. import settings
 from .. import shared
 
 from . import collection
@@ -93,6 +98,10 @@ class Info(object):
   def RepositoryUrl(self):
     return 'https://api.github.com/repos/{owner}/{repo}'.format(**self.__dict__)
 
+  def TarballUrl(self, ref):
+    return ('https://api.github.com/repos/{owner}/{repo}/tarball/{ref}'
+            .format(ref=ref, **self.__dict__))
+
   def BranchesUrl(self):
     if self.branch is None:
       fetched = FetchAsyncWithAuth(self.RepositoryUrl())
@@ -138,6 +147,12 @@ def IsValidUrl(url):
   return _GITHUB_URL_RE.match(url)
 
 
+def GitBlobSha(contents):
+  """Returns the SHA git uses to identify a blob with the given contents."""
+  header = 'blob {}\0'.format(len(contents))
+  return hashlib.sha1(header + contents).hexdigest()
+
+
 def FetchAsyncWithAuth(*args, **kwargs):
   credential = model.GetOAuth2Credential('github')
   if credential:
@@ -201,7 +216,7 @@ class GithubRepoCollection(collection.RepoCollection):
              and entry['html_url'] not in _PROJECT_URL_SKIP_LIST]
 
     # fetch master_branch url for each repo
-    candidates1 = []
+    branches_urls = []
     for repo in repos:
       # only proceed with repos which look like App Engine Python projects
       if not self._IsAppEnginePythonRepo(repo['name']):
@@ -211,42 +226,38 @@ class GithubRepoCollection(collection.RepoCollection):
 
       info = Info(user=repo['owner']['login'], repo=repo['name'],
                   branch=repo['master_branch'])
-      branches_url = info.BranchesUrl()
-      fetched = FetchAsyncWithAuth(branches_url)
-      candidates1.append((repo, fetched))
+      branches_urls.append((repo, info.BranchesUrl()))
 
     # fetch tree url for each repo
-    candidates2 = []
-    for repo, fetched in candidates1:
+    tree_urls = []
+    for repo, fetched in fetcher.FetchUnordered(branches_urls,
+                                                FetchAsyncWithAuth):
       try:
         data = fetched.json_content
       except fetcher.FetchError:
         continue
-
       # see http://developer.github.com/v3/git/trees/
-      tree_url = data['commit']['commit']['tree']['url'] + '?recursive=1'
-
-      fetched = FetchAsyncWithAuth(tree_url)
-      candidates2.append((repo, fetched))
+      tree_urls.append((repo, data['commit']['commit']['tree']['url'] +
+                        '?recursive=1'))
 
     # filter for trees containing 'app.yaml'
-    candidates3 = []
-    for repo, fetched in candidates2:
+    app_yaml_urls = []
+    for repo, fetched in fetcher.FetchUnordered(tree_urls, FetchAsyncWithAuth):
       data = fetched.json_content
-
-      app_yaml_urls = [
+      urls = [
           entry['url'] for entry in data['tree']
           if entry['path'] == 'app.yaml' and entry['type'] == 'blob'
       ]
-      if not app_yaml_urls:
+      if not urls:
         shared.w('skipping repo due to missing app.yaml: {}'
                  .format(repo['html_url']))
         continue
-      fetched = FetchAsyncWithAuth(app_yaml_urls[0])
-      candidates3.append((repo, fetched))
+      app_yaml_urls.append((repo, urls[0]))
 
     # filter repos whose app.yaml does not contain 'runtime: python27'
-    for repo, fetched in candidates3:
+    python_repos = []
+    for repo, fetched in fetcher.FetchUnordered(app_yaml_urls,
+                                                FetchAsyncWithAuth):
       data = fetched.json_content
       base64_content = data['content']
       decoded_content = base64.b64decode(base64_content)
@@ -256,9 +267,9 @@ class GithubRepoCollection(collection.RepoCollection):
         shared.w('skipping repo due to "runtime: {}" app {}'
                  .format(runtime, repo['html_url']))
         continue
-      repos.append(repo)
+      python_repos.append(repo)
 
-    return repos
+    return python_repos
 
   def PopulateRepos(self):
     """Populate repos."""
@@ -288,7 +299,7 @@ class GithubRepoCollection(collection.RepoCollection):
                             read_only_files=[],
                             read_only_demo_url=None)
 
-  def CreateProjectTreeFromRepo(self, tree, repo):
+  def _GetBranchCommit(self, repo):
     # e.g. https://github.com/GoogleCloudPlatform/appengine-guestbook-python
     # e.g. https://github.com/GoogleCloudPlatform/appengine-guestbook-python/tree/part6-staticfiles
     html_url = repo.key.id()
@@ -298,24 +309,125 @@ class GithubRepoCollection(collection.RepoCollection):
     branches_url = info.BranchesUrl()
     fetched = FetchAsyncWithAuth(branches_url)
     data = fetched.json_content
+    return info, data['commit']
 
+  def _GetTreeBlobs(self, commit):
     # see http://developer.github.com/v3/git/trees/
-    tree_url = data['commit']['commit']['tree']['url'] + '?recursive=1'
+    tree_url = commit['commit']['tree']['url'] + '?recursive=1'
     fetched = FetchAsyncWithAuth(tree_url)
     data = fetched.json_content
+    return [entry for entry in data['tree'] if entry['type'] == 'blob']
 
-    entries = [entry for entry in data['tree'] if entry['type'] == 'blob']
-    fetches = []
-    for entry in entries:
-      fetched = FetchAsyncWithAuth(entry['url'])
-      fetches.append((entry, fetched))
+  def CreateProjectTreeFromRepo(self, tree, repo):
+    info, commit = self._GetBranchCommit(repo)
+    sha = commit['sha']
+
+    try:
+      blobs = self._CreateProjectTreeFromTarball(tree, info, sha)
+      complete = True
+    except (urlfetch_errors.Error, tarfile.TarError):
+      exc_info = sys.exc_info()
+      formatted_exception = traceback.format_exception(exc_info[0],
+                                                       exc_info[1],
+                                                       exc_info[2])
+      shared.w('falling back to per blob retrieval of {0}'
+               .format(repo.key.id()))
+      for line in [line for line in formatted_exception if line]:
+        shared.w(line)
+      entries = self._GetTreeBlobs(commit)
+      blobs = self._PutBlobs(tree, entries)
+      complete = len(blobs) == len(entries)
+
+    model.PutTemplateSnapshot(repo, sha, blobs, complete)
+    return sha
+
+  def UpdateProjectTreeFromRepo(self, tree, repo):
+    snapshot = (repo.imported_sha and
+                model.GetTemplateSnapshot(repo, repo.imported_sha))
+    if not snapshot:
+      return None
+    unused_info, commit = self._GetBranchCommit(repo)
+    sha = commit['sha']
+    if sha == repo.imported_sha and snapshot.complete:
+      shared.i('{} is already at {}'.format(repo.key.id(), sha))
+      return sha
+
+    entries = self._GetTreeBlobs(commit)
+    old_blobs = snapshot.blobs
+    # includes files which could not be retrieved by a previous import
+    changed = [entry for entry in entries
+               if old_blobs.get(entry['path']) != entry['sha']]
+    blobs = dict((entry['path'], entry['sha']) for entry in entries)
+    shared.i('updating {} from {} to {}: {} of {} files changed'
+             .format(repo.key.id(), repo.imported_sha, sha, len(changed),
+                     len(entries)))
+    written = self._PutBlobs(tree, changed)
+    complete = True
+    for entry in changed:
+      if entry['path'] not in written:
+        # retry next time
+        del blobs[entry['path']]
+        complete = False
+    for path in old_blobs:
+      if path not in blobs:
+        tree.DeletePath(path)
+
+    model.PutTemplateSnapshot(repo, sha, blobs, complete)
+    return sha
+
+  def _CreateProjectTreeFromTarball(self, tree, info, sha):
+    """Populate project from a single tarball of the given commit.
 
-    for entry, fetched in fetches:
+    Args:
+      tree: The Tree to populate.
+      info: The Info of the github repo.
+      sha: The commit SHA.
+
+    Returns:
+      A dict mapping the written file paths to git blob SHAs.
+    """
+    # see http://developer.github.com/v3/repos/contents/#get-archive-link
+    # the archive of a commit never changes, so there is nothing to revalidate
+    fetched = FetchAsyncWithAuth(
+        info.TarballUrl(sha), follow_redirects=True,
+        deadline=settings.ARCHIVE_FETCH_DEADLINE_SECONDS, use_cache=False)
+    buf = cStringIO.StringIO(fetched.content)
+    blobs = {}
+    files = {}
+    with contextlib.closing(tarfile.open(fileobj=buf, mode='r:*')) as tar:
+      for member in tar:
+        if not member.isfile():
+          continue
+        # strip the '{owner}-{repo}-{sha}/' top level directory
+        path = member.name.split('/', 1)[-1]
+        files[path] = tar.extractfile(member).read()
+        blobs[path] = GitBlobSha(files[path])
+        if len(files) >= settings.TREE_WRITE_BATCH_SIZE:
+          tree.PutFiles(files)
+          files = {}
+    if files:
+      tree.PutFiles(files)
+    return blobs
+
+  def _PutBlobs(self, tree, entries):
+    """Populate project by retrieving each of the given git tree blobs.
+
+    Args:
+      tree: The Tree to populate.
+      entries: The git tree blob entries.
+
+    Returns:
+      A dict mapping the written file paths to git blob SHAs.
+    """
+    blob_urls = [(entry, entry['url']) for entry in entries]
+    blobs = {}
+    files = {}
+    for entry, fetched in fetcher.FetchUnordered(blob_urls, FetchAsyncWithAuth):
       try:
         data = fetched.json_content
         base64_content = data['content']
-        decoded_content = base64.b64decode(base64_content)
-        tree.SetFile(entry['path'], decoded_content)
+        files[entry['path']] = base64.b64decode(base64_content)
+        blobs[entry['path']] = entry['sha']
       except urlfetch_errors.Error:
         exc_info = sys.exc_info()
         formatted_exception = traceback.format_exception(exc_info[0],
@@ -324,3 +436,9 @@ class GithubRepoCollection(collection.RepoCollection):
         shared.w('skipping {0} {1}'.format(entry['path'], entry['url']))
         for line in [line for line in formatted_exception if line]:
           shared.w(line)
+      if len(files) >= settings.TREE_WRITE_BATCH_SIZE:
+        tree.PutFiles(files)
+        files = {}
+    if files:
+      tree.PutFiles(files)
+    return blobs
@@ -0,0 +1,105 @@
+"""Tests for github."""
+
+import cStringIO
+import tarfile
+import unittest
+
+from .. import settings
+from . import github
+
+
+class GitBlobShaTest(unittest.TestCase):
+
+  def testMatchesGitHashObject(self):
+    # expected values from `git hash-object --stdin`
+    vectors = [
+        ('', 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'),
+        ('hello world\n', '3b18e512dba79e4c8300dd08aeb37f8e728b8dad'),
+        ('what is up, doc?', 'bd9dbf5aae1a3862dd1526723246b20206e5fc37'),
+        ('\x00\xff\x80binary', '4caab6114e871e7335ce9d9080347fa3162b7ec3'),
+    ]
+    for contents, sha in vectors:
+      self.assertEqual(sha, github.GitBlobSha(contents))
+
+
+class _FakeTree(object):
+
+  def __init__(self):
+    self.batches = []
+
+  def PutFiles(self, files):
+    self.batches.append(dict(files))
+
+
+class _FakeFetched(object):
+
+  def __init__(self, content):
+    self.content = content
+
+
+def _MakeTarball(files):
+  buf = cStringIO.StringIO()
+  tar = tarfile.open(fileobj=buf, mode='w:gz')
+  top = tarfile.TarInfo('owner-repo-abc123')
+  top.type = tarfile.DIRTYPE
+  tar.addfile(top)
+  for path, contents in files:
+    info = tarfile.TarInfo('owner-repo-abc123/{}'.format(path))
+    info.size = len(contents)
+    tar.addfile(info, cStringIO.StringIO(contents))
+  tar.close()
+  return buf.getvalue()
+
+
+class CreateProjectTreeFromTarballTest(unittest.TestCase):
+
+  def setUp(self):
+    self.files = [
+        ('app.yaml', 'application: foo\n'),
+        ('main.py', 'print 1\n'),
+        ('static/a.css', 'a {}\n'),
+        ('static/img/empty.txt', ''),
+        ('lib/b.py', 'pass\n'),
+    ]
+    self.fetches = []
+    self._real_fetch = github.FetchAsyncWithAuth
+    self._real_batch_size = settings.TREE_WRITE_BATCH_SIZE
+    github.FetchAsyncWithAuth = self._Fetch
+    settings.TREE_WRITE_BATCH_SIZE = 2
+
+  def tearDown(self):
+    github.FetchAsyncWithAuth = self._real_fetch
+    settings.TREE_WRITE_BATCH_SIZE = self._real_batch_size
+
+  def _Fetch(self, url, **kwargs):
+    self.fetches.append((url, kwargs))
+    return _FakeFetched(_MakeTarball(self.files))
+
+  def testCreateProjectTreeFromTarball(self):
+    tree = _FakeTree()
+    collection = github.GithubRepoCollection(None)
+    info = github.Info('owner', 'repo')
+    blobs = collection._CreateProjectTreeFromTarball(tree, info, 'abc123')
+
+    self.assertEqual(1, len(self.fetches))
+    url, kwargs = self.fetches[0]
+    self.assertEqual(info.TarballUrl('abc123'), url)
+    self.assertFalse(kwargs['use_cache'])
+    self.assertEqual(settings.ARCHIVE_FETCH_DEADLINE_SECONDS,
+                     kwargs['deadline'])
+
+    # the top level directory is stripped and files are written in batches
+    self.assertEqual([2, 2, 1], [len(batch) for batch in tree.batches])
+    written = {}
+    for batch in tree.batches:
+      written.update(batch)
+    self.assertEqual(dict(self.files), written)
+    self.assertEqual(
+        dict((path, github.GitBlobSha(contents))
+             for path, contents in self.files), blobs)
+    self.assertEqual('e69de29bb2d1d6434b8b29ae775ad8c2e48c5391',
+                     blobs['static/img/empty.txt'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -23,10 +23,15 @@ import urllib
 from mimic.__mimic import common
 
 from error import Abort
+from . import control
 from . import settings
 from . import shared
 
 
+# URL Fetch deadline for batch requests which transfer many files at once
+_BATCH_URL_FETCH_DEADLINE = 30
+
+
 class UrlFetchTree(common.Tree):
   """An implementation of Tree backed by URL Fetch."""
 
@@ -91,19 +96,50 @@ class UrlFetchTree(common.Tree):
       return None
     return resp.content
 
+  def Stat(self, path):
+    """Retrieve file metadata via URL Fetch, without the file contents.
+
+    Args:
+      path: The file path.
+
+    Returns:
+      A dict containing the file 'size', 'mtime' and 'etag', or None if the
+      file does not exist.
+    """
+    url = self._ToFileURL('stat', {'path': path})
+    resp = shared.Fetch(self.access_key, url, method='GET')
+    if resp.status_code != httplib.OK:
+      return None
+    data = json.loads(resp.content)
+    mtime = datetime.datetime.strptime(data['last_modified'],
+                                       common.RFC_1123_DATE_FORMAT)
+    return {'size': data['size'], 'mtime': mtime, 'etag': data['etag']}
+
+  def GetManifestEtags(self):
+    """Retrieve the content hash of every file in the tree via URL Fetch.
+
+    Returns:
+      A dict mapping file paths to etags, or None if no manifest is available.
+    """
+    url = self._ToFileURL('manifest', {})
+    resp = shared.Fetch(self.access_key, url, method='GET')
+    if resp.status_code != httplib.OK:
+      shared.w('{0} status code during HTTP GET on {1}'
+               .format(resp.status_code, url))
+      return None
+    return json.loads(resp.content)['etags']
+
   def GetFileSize(self, path):
-    contents = self.GetFileContents(path)
-    if contents is None:
+    stat = self.Stat(path)
+    if stat is None:
       return None
-    return len(contents)
+    return stat['size']
 
   def GetFileLastModified(self, path):
-    resp = self.RemoteGetFile(path)
-    if resp.status_code != httplib.OK:
+    stat = self.Stat(path)
+    if stat is None:
       return None
-    date_header = resp.headers['Last-Modified']
-    date = datetime.datetime.strptime(date_header, common.RFC_1123_DATE_FORMAT)
-    return date
+    return stat['mtime']
 
   def HasFile(self, path):
     # root always exists, even if there are no files in the tree
@@ -154,6 +190,40 @@ class UrlFetchTree(common.Tree):
     resp = self.RemotePutFile(path, contents)
     assert resp.status_code == httplib.OK
 
+  def GetFiles(self, path):
+    """Retrieve all files in a directory or tree with a single URL Fetch.
+
+    Args:
+      path: The directory path or None to retrieve the entire tree.
+
+    Returns:
+      A dict mapping file paths to file contents.
+    """
+    params = {}
+    if path is not None:
+      params['path'] = path
+    url = self._ToFileURL('files', params)
+    resp = shared.Fetch(self.access_key, url, method='GET',
+                        deadline=_BATCH_URL_FETCH_DEADLINE)
+    # never decode an error response as files
+    assert resp.status_code == httplib.OK, (
+        '{0} status code during HTTP GET on {1}'.format(resp.status_code, url))
+    return control.DecodeFiles(json.loads(resp.content))
+
+  def PutFiles(self, files):
+    """Put many files with a single URL Fetch.
+
+    Args:
+      files: A dict mapping file paths to file contents.
+    """
+    url = self._ToFileURL('files', {})
+    payload = json.dumps(control.EncodeFiles(files))
+    resp = shared.Fetch(self.access_key, url, method='PUT', payload=payload,
+                        deadline=_BATCH_URL_FETCH_DEADLINE)
+    # fail like SetFile, rather than let e.g. model.CopyTree copy nothing
+    assert resp.status_code == httplib.OK, (
+        '{0} status code during HTTP PUT on {1}'.format(resp.status_code, url))
+
   def HasDirectory(self, path):
     return bool(self.ListDirectory(path))
 
@@ -173,17 +243,4 @@ class UrlFetchTree(common.Tree):
       shared.e('{0} status code during HTTP GET on {1}'
                .format(resp.status_code, url))
     files = json.loads(resp.content)
-    paths = set()
-    for f in files:
-      candidate_path = f['path']
-      # 'path is None' means get all files recursively
-      if path is None:
-        paths.add(candidate_path)
-        continue
-      if not candidate_path.startswith(path):
-        continue
-      tail = candidate_path[len(path):]
-      # return tail if tail is a file otherwise return dir name (=first segment)
-      subpath = tail.split('/', 1)[0]
-      paths.add(subpath)
-    return sorted(paths)
+    return shared.ListDirectoryPaths([f['path'] for f in files], path)
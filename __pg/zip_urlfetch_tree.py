@@ -19,20 +19,194 @@ import cStringIO
 import datetime
 import httplib
 import json
+import tempfile
 import urllib
 import zipfile
 
+try:
+  import mmap  # pylint: disable-msg=C6204
+except ImportError:
+  # not available in the App Engine Python 2.7 sandbox
+  mmap = None
+
 from mimic.__mimic import common
 
 from error import Abort
+from . import control
+from . import lru
 from . import settings
 from . import shared
 
-from google.appengine.api import urlfetch
+
+# instance wide caches of namespace -> _Snapshot, held in memory or on disk
+_SNAPSHOTS = lru.LRUCache(settings.ZIP_CACHE_MAX_BYTES)
+_SPILLED_SNAPSHOTS = lru.LRUCache(settings.ZIP_SPILL_CACHE_MAX_BYTES)
+
+
+def _CanSpill(zip_size):
+  threshold = settings.ZIP_CACHE_SPILL_THRESHOLD_BYTES
+  return mmap is not None and threshold is not None and zip_size >= threshold
+
+
+def _GetCachedSnapshot(namespace):
+  if namespace in _SNAPSHOTS:
+    return _SNAPSHOTS.Get(namespace)
+  return _SPILLED_SNAPSHOTS.Get(namespace)
+
+
+def _CacheSnapshot(namespace, snapshot):
+  _UncacheSnapshot(namespace)
+  cache = _SPILLED_SNAPSHOTS if snapshot.spilled else _SNAPSHOTS
+  cache.Put(namespace, snapshot, snapshot.size)
+
+
+def _UncacheSnapshot(namespace):
+  # evicted spilled snapshots release their file once no tree references them
+  _SNAPSHOTS.Pop(namespace)
+  _SPILLED_SNAPSHOTS.Pop(namespace)
+
+
+class _MappedFile(object):
+  """Read-only file object over a memory map, as required by zipfile."""
+
+  def __init__(self, fileobj):
+    self._mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def read(self, n=-1):  # pylint:disable-msg=invalid-name
+    if n < 0:
+      n = len(self._mmap) - self._mmap.tell()
+    return self._mmap.read(n)
+
+  def seek(self, offset, whence=0):  # pylint:disable-msg=invalid-name
+    self._mmap.seek(offset, whence)
+
+  def tell(self):  # pylint:disable-msg=invalid-name
+    return self._mmap.tell()
+
+
+class _DirectoryNode(object):
+  """A directory in a _DirectoryIndex."""
+
+  def __init__(self):
+    # name -> _DirectoryNode
+    self.children = {}
+    # full paths of the files directly within this directory
+    self.files = []
+    # lazily computed sorted full paths of all files below this directory
+    self._listing = None
+
+  def Listing(self):
+    if self._listing is None:
+      listing = list(self.files)
+      for child in self.children.itervalues():
+        listing.extend(child.Listing())
+      self._listing = sorted(listing)
+    return self._listing
+
+
+class _DirectoryIndex(object):
+  """A prefix trie of the directories in a set of file paths."""
+
+  def __init__(self, paths):
+    self._root = _DirectoryNode()
+    for path in paths:
+      node = self._root
+      for name in path.split('/')[:-1]:
+        node = node.children.setdefault(name, _DirectoryNode())
+      node.files.append(path)
+
+  def _Find(self, path):
+    node = self._root
+    for name in (path or '').rstrip('/').split('/'):
+      if not name:
+        continue
+      node = node.children.get(name)
+      if node is None:
+        return None
+    return node
+
+  def HasDirectory(self, path):
+    node = self._Find(path)
+    return bool(node and (node.files or node.children))
+
+  def ListDirectory(self, path):
+    """Returns the sorted full paths of all files below the given directory."""
+    node = self._Find(path)
+    if node is None:
+      return []
+    return list(node.Listing())
+
+
+class _Snapshot(object):
+  """The files of a project at a given manifest version.
+
+  Consists of a downloaded project zip plus the files which changed since.
+  Large zips may be spilled to a memory mapped temporary file, so that reads
+  come from the page cache rather than the Python heap.
+  """
+
+  def __init__(self, version, zip_content):
+    self.version = version
+    self.zip_size = len(zip_content)
+    self.size = self.zip_size
+    self.spilled = _CanSpill(self.zip_size)
+    if self.spilled:
+      # the temporary file is deleted when closed, i.e. garbage collected
+      self._file = tempfile.TemporaryFile()
+      self._file.write(zip_content)
+      self._file.flush()
+      buf = _MappedFile(self._file)
+    else:
+      buf = cStringIO.StringIO(zip_content)
+    self.zipfile = zipfile.ZipFile(buf)
+    self.paths = set(self.zipfile.namelist())
+    self.index = _DirectoryIndex(self.paths)
+    # path -> (contents, mtime) of files changed after the zip was downloaded
+    self.overlay = {}
+
+  def ApplyDelta(self, delta):
+    """Bring the snapshot up to date.
+
+    Args:
+      delta: The JSON response of control.DELTA_PATH.
+    """
+    files = control.DecodeFiles(delta['files'])
+    for path, contents in files.iteritems():
+      mtime = datetime.datetime.strptime(delta['mtimes'][path],
+                                         common.RFC_1123_DATE_FORMAT)
+      self.overlay[path] = (contents, mtime)
+    self.paths = set(delta['paths'])
+    self.index = _DirectoryIndex(self.paths)
+    for path in self.overlay.keys():
+      if path not in self.paths:
+        del self.overlay[path]
+    self.size = (self.zip_size +
+                 sum(len(c) for c, _ in self.overlay.itervalues()))
+    self.version = delta['version']
+
+  def GetFileContents(self, path):
+    if path in self.overlay:
+      return self.overlay[path][0]
+    with self.zipfile.open(path) as f:
+      return f.read()
+
+  def GetFileSize(self, path):
+    if path in self.overlay:
+      return len(self.overlay[path][0])
+    return self.zipfile.getinfo(path).file_size
+
+  def GetFileLastModified(self, path):
+    if path in self.overlay:
+      return self.overlay[path][1]
+    return datetime.datetime(*self.zipfile.getinfo(path).date_time)
 
 
 class ZipUrlFetchTree(common.Tree):
-  """An implementation of Tree backed by ZIP download via URL Fetch."""
+  """An implementation of Tree backed by ZIP download via URL Fetch.
+
+  Downloaded zips are cached on the instance and kept up to date by
+  retrieving only the files which changed since the zip was downloaded.
+  """
 
   def __init__(self, namespace, access_key):
     if not namespace:
@@ -42,54 +216,85 @@ class ZipUrlFetchTree(common.Tree):
     super(ZipUrlFetchTree, self).__init__(namespace, access_key)
     self.namespace = namespace
     self.access_key = access_key
+    self._snapshot = self._GetSnapshot()
 
-    path_info = '{}/zip'.format(common.CONTROL_PREFIX)
-    query_params = '{}={}&use_basepath=false'.format(
-      common.config.PROJECT_ID_QUERY_PARAM, namespace)
+  def __repr__(self):
+    return ('<{0} namespace={1!r}>'
+            .format(self.__class__.__name__, self.namespace))
+
+  def _ToControlURL(self, control_path, params):
+    params = params.copy()
+    params[common.config.PROJECT_ID_QUERY_PARAM] = self.namespace
+    path_info = '{}/{}'.format(common.CONTROL_PREFIX, control_path)
     playground_hostname = (settings.PLAYGROUND_USER_CONTENT_HOST or
                            settings.PLAYGROUND_HOSTS[0])
-    url = 'https://{}{}?{}'.format(playground_hostname, path_info, query_params)
+    return 'https://{}{}?{}'.format(playground_hostname, path_info,
+                                    urllib.urlencode(params))
 
-    result = shared.Fetch(access_key, url, method='GET', deadline=30, retries=3)
-    buf = cStringIO.StringIO(result.content)
-    self._zipfile = zipfile.ZipFile(buf)
+  def _FetchDelta(self, since):
+    params = {}
+    if since is not None:
+      params['since'] = since
+    url = self._ToControlURL('delta', params)
+    resp = shared.Fetch(self.access_key, url, method='GET', deadline=30)
+    if resp.status_code != httplib.OK:
+      shared.w('{0} status code during HTTP GET on {1}'
+               .format(resp.status_code, url))
+      return None
+    return json.loads(resp.content)
 
-  def __repr__(self):
-    return ('<{0} namespace={1!r}>'
-            .format(self.__class__.__name__, self.namespace))
+  def _FetchZip(self):
+    url = self._ToControlURL('zip', {'use_basepath': 'false'})
+    result = shared.Fetch(self.access_key, url, method='GET', deadline=30,
+                          retries=3)
+    return result.content
+
+  def _GetSnapshot(self):
+    """Get an up to date snapshot of the project files."""
+    snapshot = _GetCachedSnapshot(self.namespace)
+    if snapshot:
+      delta = self._FetchDelta(snapshot.version)
+      if delta and delta['version'] == snapshot.version:
+        return snapshot
+      if delta:
+        snapshot.ApplyDelta(delta)
+        _CacheSnapshot(self.namespace, snapshot)
+        return snapshot
+      _UncacheSnapshot(self.namespace)
+    # determine the version before downloading, so that changes made during
+    # the download are picked up by the next delta
+    delta = self._FetchDelta(None)
+    snapshot = _Snapshot(delta and delta['version'], self._FetchZip())
+    if delta:
+      _CacheSnapshot(self.namespace, snapshot)
+    return snapshot
 
   def IsMutable(self):
     return False
 
   def GetFileContents(self, path):
-    if path not in self._zipfile.namelist():
+    if path not in self._snapshot.paths:
       return None
-    with self._zipfile.open(path) as f:
-      return f.read()
+    return self._snapshot.GetFileContents(path)
 
   def GetFileSize(self, path):
-    if path not in self._zipfile.namelist():
+    if path not in self._snapshot.paths:
       return 0
-    return self._zipfile.getinfo(path).file_size
+    return self._snapshot.GetFileSize(path)
 
   def GetFileLastModified(self, path):
-    dt = self._zipfile.getinfo(path).date_time
-    return datetime.datetime(*dt)
+    return self._snapshot.GetFileLastModified(path)
 
   def HasFile(self, path):
     # root always exists, even if there are no files in the tree
     if path == '':  # pylint: disable-msg=C6403
       return True
-    return path in self._zipfile.namelist()
+    return path in self._snapshot.paths
 
   def HasDirectory(self, path):
     path = self._NormalizeDirectoryPath(path)
-    for p in self._zipfile.namelist():
-      if p.startswith(path):
-        return True
-    return False
+    return self._snapshot.index.HasDirectory(path)
 
   def ListDirectory(self, path):
     path = self._NormalizeDirectoryPath(path)
-    paths = [p for p in self._zipfile.namelist() if p.startswith(path)]
-    return sorted(paths)
+    return self._snapshot.index.ListDirectory(path)
@@ -0,0 +1,135 @@
+"""Tests for zip_urlfetch_tree."""
+
+import cStringIO
+import datetime
+import unittest
+import zipfile
+
+from mimic.__mimic import common
+
+from . import control
+from . import zip_urlfetch_tree
+
+
+def _MakeZip(files):
+  buf = cStringIO.StringIO()
+  z = zipfile.ZipFile(buf, 'w')
+  for path, contents in files.iteritems():
+    info = zipfile.ZipInfo(path, date_time=(2014, 1, 2, 3, 4, 6))
+    z.writestr(info, contents)
+  z.close()
+  return buf.getvalue()
+
+
+def _MakeDelta(version, files, paths, mtime):
+  mtime = mtime.strftime(common.RFC_1123_DATE_FORMAT)
+  return {
+      'version': version,
+      'files': control.EncodeFiles(files),
+      'mtimes': dict((path, mtime) for path in files),
+      'paths': paths,
+  }
+
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.snapshot = zip_urlfetch_tree._Snapshot(1, _MakeZip({
+        'app.yaml': 'application: foo\n',
+        'main.py': 'print 1\n',
+        'static/a.css': 'a {}\n',
+    }))
+    self.mtime = datetime.datetime(2015, 6, 7, 8, 9, 10)
+
+  def testZipContents(self):
+    self.assertEqual(1, self.snapshot.version)
+    self.assertEqual('print 1\n', self.snapshot.GetFileContents('main.py'))
+    self.assertEqual(5, self.snapshot.GetFileSize('static/a.css'))
+    self.assertEqual(datetime.datetime(2014, 1, 2, 3, 4, 6),
+                     self.snapshot.GetFileLastModified('main.py'))
+
+  def testApplyDeltaOverlaysChangedFiles(self):
+    self.snapshot.ApplyDelta(_MakeDelta(
+        2, {'main.py': 'print 2\n', 'new.py': 'new\n'},
+        ['app.yaml', 'main.py', 'new.py', 'static/a.css'], self.mtime))
+    self.assertEqual(2, self.snapshot.version)
+    self.assertEqual('print 2\n', self.snapshot.GetFileContents('main.py'))
+    self.assertEqual(8, self.snapshot.GetFileSize('main.py'))
+    self.assertEqual(self.mtime,
+                     self.snapshot.GetFileLastModified('main.py'))
+    self.assertEqual('new\n', self.snapshot.GetFileContents('new.py'))
+    # unchanged files are still read from the zip
+    self.assertEqual('application: foo\n',
+                     self.snapshot.GetFileContents('app.yaml'))
+    self.assertEqual(set(['app.yaml', 'main.py', 'new.py', 'static/a.css']),
+                     self.snapshot.paths)
+    self.assertEqual(self.snapshot.zip_size + len('print 2\n') + len('new\n'),
+                     self.snapshot.size)
+
+  def testApplyDeltaRemovesDeletedFiles(self):
+    self.snapshot.ApplyDelta(_MakeDelta(
+        2, {'new.py': 'new\n'},
+        ['app.yaml', 'main.py', 'new.py', 'static/a.css'], self.mtime))
+    self.snapshot.ApplyDelta(_MakeDelta(3, {}, ['app.yaml'], self.mtime))
+    self.assertEqual(3, self.snapshot.version)
+    self.assertEqual(set(['app.yaml']), self.snapshot.paths)
+    self.assertEqual({}, self.snapshot.overlay)
+    self.assertEqual(self.snapshot.zip_size, self.snapshot.size)
+    self.assertFalse(self.snapshot.index.HasDirectory('static'))
+    self.assertEqual(['app.yaml'], self.snapshot.index.ListDirectory(None))
+
+  def testApplyDeltaKeepsEarlierChanges(self):
+    self.snapshot.ApplyDelta(_MakeDelta(
+        2, {'main.py': 'print 2\n'},
+        ['app.yaml', 'main.py', 'static/a.css'], self.mtime))
+    self.snapshot.ApplyDelta(_MakeDelta(
+        3, {'app.yaml': 'application: bar\n'},
+        ['app.yaml', 'main.py', 'static/a.css'], self.mtime))
+    self.assertEqual('print 2\n', self.snapshot.GetFileContents('main.py'))
+    self.assertEqual('application: bar\n',
+                     self.snapshot.GetFileContents('app.yaml'))
+
+
+class DirectoryIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.index = zip_urlfetch_tree._DirectoryIndex([
+        'app.yaml',
+        'static/b.css',
+        'static/a.css',
+        'static/img/logo.png',
+        'staticfiles/c.js',
+    ])
+
+  def testHasDirectory(self):
+    self.assertTrue(self.index.HasDirectory(None))
+    self.assertTrue(self.index.HasDirectory(''))
+    self.assertTrue(self.index.HasDirectory('static'))
+    self.assertTrue(self.index.HasDirectory('static/'))
+    self.assertTrue(self.index.HasDirectory('static/img'))
+    self.assertFalse(self.index.HasDirectory('stat'))
+    self.assertFalse(self.index.HasDirectory('app.yaml'))
+    self.assertFalse(self.index.HasDirectory('missing'))
+
+  def testListDirectory(self):
+    self.assertEqual(['static/a.css', 'static/b.css', 'static/img/logo.png'],
+                     self.index.ListDirectory('static/'))
+    self.assertEqual(['static/img/logo.png'],
+                     self.index.ListDirectory('static/img'))
+    self.assertEqual(['app.yaml', 'static/a.css', 'static/b.css',
+                      'static/img/logo.png', 'staticfiles/c.js'],
+                     self.index.ListDirectory(None))
+    self.assertEqual([], self.index.ListDirectory('missing'))
+
+  def testListDirectoryReturnsACopy(self):
+    self.index.ListDirectory('static').append('bogus')
+    self.assertNotIn('bogus', self.index.ListDirectory('static'))
+
+  def testEmpty(self):
+    index = zip_urlfetch_tree._DirectoryIndex([])
+    self.assertFalse(index.HasDirectory(None))
+    self.assertEqual([], index.ListDirectory(None))
+
+
+if __name__ == '__main__':
+  unittest.main()
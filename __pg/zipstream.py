@@ -0,0 +1,127 @@
+"""Streaming zip archive writer.
+
+Unlike zipfile, which needs a seekable file object holding the whole archive,
+the archive is produced as a sequence of byte strings which can be sent to
+the client while later files are still being read. Compressed sizes are not
+known until a file has been deflated, so they follow each file's data in a
+data descriptor, as permitted by the zip format. ZIP64 is not supported.
+"""
+
+import struct
+import zlib
+
+
+# compression methods
+STORED = 0
+DEFLATED = 8
+
+# amount of uncompressed data deflated before output is yielded
+CHUNK_SIZE = 64 * 1024
+
+_LOCAL_FILE_HEADER = struct.Struct('<IHHHHHIIIHH')
+_LOCAL_FILE_HEADER_SIGNATURE = 0x04034b50
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+_CENTRAL_DIRECTORY_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_CENTRAL_DIRECTORY_HEADER_SIGNATURE = 0x02014b50
+_END_OF_CENTRAL_DIRECTORY = struct.Struct('<IHHHHIIH')
+_END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06054b50
+
+# version 2.0, the first to support deflate and data descriptors
+_VERSION = 20
+
+# made by a Unix host, so that the external attributes are interpreted
+_VERSION_MADE_BY = 3 << 8 | _VERSION
+
+# general purpose flags
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+# regular file, rw-r--r--
+_EXTERNAL_ATTR = 0100644 << 16
+
+
+def _DosDateTime(mtime):
+  """Convert a datetime to the MS-DOS (date, time) pair used by zip files."""
+  if mtime is None or mtime.year < 1980:
+    # the earliest representable date, 1980-01-01
+    return 1 << 5 | 1, 0
+  dos_date = (mtime.year - 1980) << 9 | mtime.month << 5 | mtime.day
+  dos_time = mtime.hour << 11 | mtime.minute << 5 | mtime.second // 2
+  return dos_date, dos_time
+
+
+def _Deflate(contents):
+  """Yield raw deflate output for contents, one chunk at a time."""
+  compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                -zlib.MAX_WBITS)
+  for i in xrange(0, len(contents), CHUNK_SIZE):
+    data = compressor.compress(contents[i:i + CHUNK_SIZE])
+    if data:
+      yield data
+  yield compressor.flush()
+
+
+def ZipStream(files, stored_extensions=(), store_only=False):
+  """Yield a zip archive of the given files as a sequence of byte strings.
+
+  Args:
+    files: An iterable of (path, contents, mtime) tuples, which is consumed
+        lazily, so that only one file needs to be held in memory at a time.
+    stored_extensions: File extensions, without the leading dot, of files
+        which are already compressed and are therefore stored as is.
+    store_only: Whether to store all files without compression.
+  """
+  stored_extensions = frozenset(ext.lower() for ext in stored_extensions)
+  # central directory records, written after all files
+  central_directory = []
+  offset = 0
+  for path, contents, mtime in files:
+    if isinstance(path, unicode):
+      path = path.encode('utf-8')
+    extension = path.rpartition('.')[2].lower() if '.' in path else ''
+    if store_only or extension in stored_extensions:
+      method = STORED
+    else:
+      method = DEFLATED
+    flags = _FLAG_UTF8
+    dos_date, dos_time = _DosDateTime(mtime)
+    crc = zlib.crc32(contents) & 0xffffffff
+    size = len(contents)
+
+    if method == STORED:
+      # sizes are known up front, no data descriptor is needed
+      header = _LOCAL_FILE_HEADER.pack(
+          _LOCAL_FILE_HEADER_SIGNATURE, _VERSION, flags, method, dos_time,
+          dos_date, crc, size, size, len(path), 0)
+      yield header + path
+      if contents:
+        yield contents
+      compressed_size = size
+      record_size = len(header) + len(path) + size
+    else:
+      flags |= _FLAG_DATA_DESCRIPTOR
+      header = _LOCAL_FILE_HEADER.pack(
+          _LOCAL_FILE_HEADER_SIGNATURE, _VERSION, flags, method, dos_time,
+          dos_date, 0, 0, 0, len(path), 0)
+      yield header + path
+      compressed_size = 0
+      for data in _Deflate(contents):
+        compressed_size += len(data)
+        yield data
+      descriptor = _DATA_DESCRIPTOR.pack(
+          _DATA_DESCRIPTOR_SIGNATURE, crc, compressed_size, size)
+      yield descriptor
+      record_size = (len(header) + len(path) + compressed_size +
+                     len(descriptor))
+
+    central_directory.append(_CENTRAL_DIRECTORY_HEADER.pack(
+        _CENTRAL_DIRECTORY_HEADER_SIGNATURE, _VERSION_MADE_BY, _VERSION,
+        flags, method, dos_time, dos_date, crc, compressed_size, size,
+        len(path), 0, 0, 0, 0, _EXTERNAL_ATTR, offset) + path)
+    offset += record_size
+
+  central_directory_size = sum(len(r) for r in central_directory)
+  yield ''.join(central_directory) + _END_OF_CENTRAL_DIRECTORY.pack(
+      _END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, len(central_directory),
+      len(central_directory), central_directory_size, offset, 0)
@@ -0,0 +1,71 @@
+"""Tests for zipstream, read back with zipfile."""
+
+import cStringIO
+import datetime
+import unittest
+import zipfile
+
+from . import zipstream
+
+
+def _ReadZip(files, **kwargs):
+  data = ''.join(zipstream.ZipStream(files, **kwargs))
+  return zipfile.ZipFile(cStringIO.StringIO(data))
+
+
+class ZipStreamTest(unittest.TestCase):
+
+  def testEmpty(self):
+    z = _ReadZip([])
+    self.assertEqual([], z.namelist())
+    self.assertIsNone(z.testzip())
+
+  def testRoundTrip(self):
+    mtime = datetime.datetime(2014, 5, 6, 7, 8, 10)
+    files = [
+        ('app.yaml', 'application: foo\n', mtime),
+        ('static/big.js', 'var x = 1;\n' * 20000, mtime),
+        ('empty.txt', '', mtime),
+    ]
+    z = _ReadZip(files)
+    self.assertIsNone(z.testzip())
+    self.assertEqual([path for path, _, _ in files], z.namelist())
+    for path, contents, _ in files:
+      self.assertEqual(contents, z.read(path))
+      info = z.getinfo(path)
+      self.assertEqual((2014, 5, 6, 7, 8, 10), info.date_time)
+      self.assertEqual(zipfile.ZIP_DEFLATED, info.compress_type)
+      self.assertEqual(3, info.create_system)
+      self.assertEqual(0100644, info.external_attr >> 16)
+
+  def testStoredExtensions(self):
+    files = [('logo.PNG', '\x89PNG' * 100, None), ('main.py', 'pass\n', None)]
+    z = _ReadZip(files, stored_extensions=('png',))
+    self.assertIsNone(z.testzip())
+    self.assertEqual(zipfile.ZIP_STORED, z.getinfo('logo.PNG').compress_type)
+    self.assertEqual(zipfile.ZIP_DEFLATED,
+                     z.getinfo('main.py').compress_type)
+    self.assertEqual('\x89PNG' * 100, z.read('logo.PNG'))
+
+  def testStoreOnly(self):
+    files = [('a.txt', 'a' * 1000, None), ('b/c.txt', 'c', None)]
+    z = _ReadZip(files, store_only=True)
+    self.assertIsNone(z.testzip())
+    for info in z.infolist():
+      self.assertEqual(zipfile.ZIP_STORED, info.compress_type)
+    self.assertEqual('a' * 1000, z.read('a.txt'))
+    self.assertEqual('c', z.read('b/c.txt'))
+
+  def testUnicodePaths(self):
+    path = u'caf\u00e9/\u65e5\u672c.txt'
+    z = _ReadZip([(path, 'contents', None)])
+    self.assertEqual([path], z.namelist())
+    self.assertEqual('contents', z.read(path))
+
+  def testDatesBefore1980(self):
+    z = _ReadZip([('old.txt', 'old', datetime.datetime(1970, 1, 1))])
+    self.assertEqual((1980, 1, 1, 0, 0, 0), z.getinfo('old.txt').date_time)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -230,7 +230,7 @@ function PageController($scope, $http, DoSerial, $routeParams, $window,
 }
 
 function MainController($scope, $http, $window, $location, $log, $routeParams,
-                        $q, Alert, DoSerial, $rootScope) {
+                        $q, Alert, DoSerial, $rootScope, $timeout) {
 
   // TODO: test
   $scope.$on('$routeChangeError', function(evt, current, previous, rejection) {
@@ -246,6 +246,13 @@ function MainController($scope, $http, $window, $location, $log, $routeParams,
       if (template_url) {
         var expiration_seconds = parseInt($routeParams.expiration_seconds);
         return $scope.new_project_from_template_url(template_url, expiration_seconds, 'auto-from-template-url')
+        .then(function(project) {
+          // wait for the project files to be copied before opening it
+          if (project.in_progress_task_name) {
+            return poll_project(project);
+          }
+          return project;
+        })
         .then(function(project) {
           $scope.select_project(project, 'auto-from-template-url');
         })
@@ -329,6 +336,22 @@ function MainController($scope, $http, $window, $location, $log, $routeParams,
     });
   };
 
+  // Poll a project whose files are still being copied until it is ready.
+  // Returns a promise for the ready project.
+  var poll_project = function(project, delay_ms) {
+    delay_ms = delay_ms || 1000;
+    return $timeout(function() {
+      return $http.get('/playground/p/' + encodeURI(project.key) + '/retrieve')
+      .then(function(resolved) {
+        angular.extend(project, resolved.data);
+        if (project.in_progress_task_name) {
+          return poll_project(project, Math.min(30 * 1000, delay_ms * 2));
+        }
+        return project;
+      });
+    }, delay_ms);
+  };
+
   $scope.new_project = function(template_project, expiration_seconds, label) {
     track('new-project', label, template_project.template_url);
     var deferred = $q.defer();
@@ -345,6 +368,9 @@ function MainController($scope, $http, $window, $location, $log, $routeParams,
     .success(function(data, status, headers, config) {
       $scope.projects.pop();
       $scope.projects.push(data);
+      if (data.in_progress_task_name) {
+        poll_project(data);
+      }
       deferred.resolve();
     })
     .error(function(data, status, headers, config) {
@@ -74,11 +74,27 @@ angular.module('playgroundApp.services', [])
 // TODO: test
 .factory('ProjectsFactory', function($http, $log, $q) {
   var projects = [];
-  return $http.get('/playground/getprojects')
-  .then(function(resolved) {
-    angular.forEach(resolved.data, function(project) {
-      projects.push(project);
+
+  // Gets a page of projects and then, recursively, any remaining pages.
+  var get_projects = function(cursor) {
+    var url = '/playground/getprojects';
+    if (cursor) {
+      url += '?cursor=' + encodeURIComponent(cursor);
+    }
+    return $http.get(url)
+    .then(function(resolved) {
+      angular.forEach(resolved.data, function(project) {
+        projects.push(project);
+      });
+      var next_cursor = resolved.headers('X-Playground-Next-Cursor');
+      if (next_cursor) {
+        return get_projects(next_cursor);
+      }
     });
+  };
+
+  return get_projects()
+  .then(function() {
     return {
       projects: projects,
 